@@ -0,0 +1,175 @@
+import os
+import io
+import sys
+import time
+import base64
+import hashlib
+import threading
+from typing import Dict
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from cache import CACHE_DIR, write_json_atomic, read_json
+
+ART_DIR = os.path.join(CACHE_DIR, 'album_art')
+# Total size of downscaled art kept; the least recently used copies go first
+ART_MAX_BYTES = 128 * 1024 * 1024
+# Longest side sent to the image model; larger art only costs decode time and upload size
+MAX_ART_SIZE = 1024
+# Cached downloads younger than this are used without asking the server
+REVALIDATE_AFTER = 60 * 60
+REQUEST_TIMEOUT = (5, 20)
+
+_session = None
+_session_lock = threading.Lock()
+_art_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """Shared HTTP session so repeated downloads reuse pooled connections."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+def _downscale(image_bytes: bytes, max_size: int = MAX_ART_SIZE) -> Image.Image:
+    image = Image.open(io.BytesIO(image_bytes))
+    # For JPEG this lets the decoder skip straight to a reduced resolution
+    image.draft('RGB', (max_size, max_size))
+    image.thumbnail((max_size, max_size))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    return image
+
+def _store(key: str, image_bytes: bytes, meta: Dict) -> str:
+    image = _downscale(image_bytes)
+    os.makedirs(ART_DIR, exist_ok=True)
+    path = os.path.join(ART_DIR, f"{key}.png")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    image.save(tmp_path, format='PNG', optimize=False)
+    os.replace(tmp_path, path)
+    write_json_atomic(os.path.join(ART_DIR, f"{key}.json"), meta)
+    _evict(keep=path)
+    print(f"Cached album art at {image.width}x{image.height} "
+          f"({len(image_bytes)} -> {os.path.getsize(path)} bytes)", file=sys.stderr)
+    return path
+
+def _evict(keep: str) -> None:
+    """Remove the least recently used copies and their metadata until the directory fits ART_MAX_BYTES."""
+    with _art_lock:
+        entries = []
+        with os.scandir(ART_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.png'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= ART_MAX_BYTES:
+                break
+            if path == keep:
+                continue
+            for stale in (path, path[:-len('.png')] + '.json'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            total -= size
+
+def _cached(key: str):
+    path = os.path.join(ART_DIR, f"{key}.png")
+    meta = read_json(os.path.join(ART_DIR, f"{key}.json"), None)
+    if meta is None:
+        return None, None
+    try:
+        # The mtime is the copy's last use for eviction
+        os.utime(path)
+    except OSError:
+        return None, None
+    return path, meta
+
+def _open(path: str) -> Image.Image:
+    with Image.open(path) as image:
+        image.load()
+        return image
+
+def _load_url(url: str) -> str:
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    path, meta = _cached(key)
+    if meta and time.time() - meta.get('checked_at', 0) < REVALIDATE_AFTER:
+        return path
+
+    headers = {}
+    if meta:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    print(f"Attempting to download album art from URL: {url}", file=sys.stderr)
+    try:
+        response = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        if path:
+            print(f"Album art revalidation failed ({str(e)}), using cached copy", file=sys.stderr)
+            return path
+        raise
+
+    if response.status_code == 304 and path:
+        meta['checked_at'] = time.time()
+        write_json_atomic(os.path.join(ART_DIR, f"{key}.json"), meta)
+        print("Album art not modified, using cached copy", file=sys.stderr)
+        return path
+    if response.status_code != 200:
+        raise ValueError(f"Failed to download album art (HTTP {response.status_code})")
+
+    return _store(key, response.content, {
+        "url": url,
+        "etag": response.headers.get('ETag'),
+        "last_modified": response.headers.get('Last-Modified'),
+        "checked_at": time.time(),
+    })
+
+def _load_bytes(key: str, read_bytes) -> str:
+    path, _ = _cached(key)
+    if path:
+        return path
+    return _store(key, read_bytes(), {"checked_at": time.time()})
+
+def album_art_path(source: str) -> str:
+    """Return the path of the cached, downscaled copy of album art from a data URI, local file or URL.
+
+    Downscaled copies are kept on disk keyed by the URL, the data URI content
+    or the file's path, size and mtime, up to ART_MAX_BYTES in total. URLs are
+    revalidated with ETag and Last-Modified once the cached copy is older than
+    REVALIDATE_AFTER.
+    """
+    if isinstance(source, str) and source.startswith('data:'):
+        base64_data = source.split(',', 1)[1]
+        key = hashlib.sha256(base64_data.encode('ascii', 'ignore')).hexdigest()
+        path = _load_bytes(key, lambda: base64.b64decode(base64_data))
+    elif os.path.dirname(os.path.abspath(source)) == os.path.abspath(ART_DIR) and os.path.exists(source):
+        # Already a downscaled copy
+        path = source
+    elif os.path.exists(source):
+        print(f"Using local album art file: {source}", file=sys.stderr)
+        stat = os.stat(source)
+        identity = f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+        key = hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+        def read_file() -> bytes:
+            with open(source, 'rb') as f:
+                return f.read()
+
+        path = _load_bytes(key, read_file)
+    else:
+        path = _load_url(source)
+    return path
+
+def load_album_art(source: str) -> Image.Image:
+    """Return album art from a data URI, local file or URL, downscaled for the image model."""
+    return _open(album_art_path(source))
@@ -0,0 +1,228 @@
+import os
+import re
+import wave
+import threading
+import subprocess
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import List, Dict, Tuple
+import numpy as np
+
+PCM_SAMPLE_RATE = 16000
+FRAME_SECONDS = 0.05
+
+@lru_cache(maxsize=2)
+def _load_pcm_cached(audio_path: str, size: int, mtime_ns: int, sample_rate: int) -> np.ndarray:
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", audio_path, "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {audio_path}: {result.stderr.decode('utf-8', 'replace').strip()}")
+    pcm = np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+    pcm.flags.writeable = False
+    return pcm
+
+def load_pcm(audio_path: str, sample_rate: int = PCM_SAMPLE_RATE) -> np.ndarray:
+    """Decode audio to mono float32 PCM, memoized for the most recent files."""
+    audio_path = os.path.abspath(audio_path)
+    stat = os.stat(audio_path)
+    return _load_pcm_cached(audio_path, stat.st_size, stat.st_mtime_ns, sample_rate)
+
+def energy_envelope(pcm: np.ndarray, sample_rate: int = PCM_SAMPLE_RATE, frame_seconds: float = FRAME_SECONDS) -> np.ndarray:
+    """RMS energy per frame."""
+    frame = max(1, int(sample_rate * frame_seconds))
+    count = len(pcm) // frame
+    if count == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = pcm[:count * frame].reshape(count, frame)
+    return np.sqrt(np.mean(frames * frames, axis=1))
+
+def _smooth(envelope: np.ndarray, frames: int) -> np.ndarray:
+    if frames <= 1 or len(envelope) < frames:
+        return envelope
+    return np.convolve(envelope, np.ones(frames) / frames, mode='same')
+
+def find_split_points(envelope: np.ndarray, frame_seconds: float = FRAME_SECONDS, target_seconds: float = 120.0,
+                      search_seconds: float = 20.0, min_chunk_seconds: float = 30.0) -> List[float]:
+    """Pick split times near every target_seconds, at the quietest point of the surrounding window."""
+    total = len(envelope) * frame_seconds
+    # Smooth over ~0.3s so a short gap inside a word does not look like silence
+    smoothed = _smooth(envelope, int(0.3 / frame_seconds))
+    points = []
+    last = 0.0
+    while total - last > target_seconds + min_chunk_seconds:
+        center = last + target_seconds
+        low = max(last + min_chunk_seconds, center - search_seconds)
+        high = min(total - min_chunk_seconds, center + search_seconds)
+        first_frame, last_frame = int(low / frame_seconds), int(high / frame_seconds)
+        if last_frame <= first_frame:
+            break
+        window = smoothed[first_frame:last_frame]
+        floor = float(window.min())
+        # Among the (near-)quietest frames, take the one closest to the target length
+        candidates = np.flatnonzero(window <= floor + 0.05 * (float(window.max()) - floor))
+        target_frame = int(center / frame_seconds) - first_frame
+        quietest = first_frame + int(candidates[np.argmin(np.abs(candidates - target_frame))])
+        last = quietest * frame_seconds
+        points.append(last)
+    return points
+
+def assign_lyric_ranges(line_count: int, chunks: List[Tuple[float, float]], envelope: np.ndarray,
+                        frame_seconds: float = FRAME_SECONDS) -> List[Tuple[int, int]]:
+    """Split lyric line indices across chunks in proportion to each chunk's active (non-silent) time."""
+    threshold = float(np.percentile(envelope, 30)) if len(envelope) else 0.0
+    active = envelope > threshold
+    weights = []
+    for start, end in chunks:
+        seconds = float(np.count_nonzero(active[int(start / frame_seconds):int(end / frame_seconds)])) * frame_seconds
+        weights.append(seconds or (end - start))
+
+    cumulative = np.cumsum(weights) / sum(weights)
+    bounds = [0] + [int(round(line_count * fraction)) for fraction in cumulative]
+    bounds[-1] = line_count
+    return [(bounds[i], max(bounds[i], bounds[i + 1])) for i in range(len(chunks))]
+
+def write_wav_chunk(pcm: np.ndarray, sample_rate: int, start: float, end: float, path: str) -> str:
+    """Write a slice of mono PCM as 16-bit WAV, reusing an existing file."""
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    samples = pcm[int(start * sample_rate):int(end * sample_rate)]
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with wave.open(tmp_path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+def _normalize_text(text: str) -> str:
+    return re.sub(r'\s+', ' ', str(text)).strip().casefold()
+
+def map_to_lines(matches: List[Dict], lines: List[str]) -> List[Tuple[int, Dict]]:
+    """Pair returned matches with positions in the given line list, in order.
+
+    Identical texts are matched first; matches left between two anchors are
+    paired positionally when the gap holds the same number of lines, which
+    covers lines the model rewrote (for example romanized Korean).
+    """
+    returned = [_normalize_text(match.get('text', '')) for match in matches]
+    expected = [_normalize_text(line) for line in lines]
+    pairs = []
+    previous_match, previous_line = 0, 0
+    for block in SequenceMatcher(None, returned, expected, autojunk=False).get_matching_blocks():
+        gap_matches = range(previous_match, block.a)
+        gap_lines = range(previous_line, block.b)
+        if len(gap_matches) == len(gap_lines):
+            pairs.extend((line_index, matches[match_index]) for match_index, line_index in zip(gap_matches, gap_lines))
+        pairs.extend((block.b + offset, matches[block.a + offset]) for offset in range(block.size))
+        previous_match, previous_line = block.a + block.size, block.b + block.size
+    return pairs
+
+def merge_chunk_alignments(lines: List[str], chunk_results: List[Dict], duration: float) -> List[Dict]:
+    """Combine per-chunk alignments into one ordered list in song time.
+
+    Each chunk result holds its ``offset``, its ``core`` line range, the
+    ``context`` range it was given and its ``matches`` in chunk time. A line
+    aligned by several chunks keeps the alignment from the chunk it was
+    assigned to. Lines no chunk aligned are placed between their neighbours.
+    """
+    best: Dict[int, Tuple[bool, Dict]] = {}
+    for chunk in chunk_results:
+        context_start, context_end = chunk['context']
+        core_start, core_end = chunk['core']
+        for relative_index, match in map_to_lines(chunk['matches'], lines[context_start:context_end]):
+            line_index = context_start + relative_index
+            in_core = core_start <= line_index < core_end
+            if line_index in best and (best[line_index][0] or not in_core):
+                continue
+            best[line_index] = (in_core, {
+                "start": float(match['start']) + chunk['offset'],
+                "end": float(match['end']) + chunk['offset'],
+                "text": match.get('text', lines[line_index]),
+                "language": match.get('language', ''),
+            })
+
+    merged = []
+    for index, line in enumerate(lines):
+        if index in best:
+            merged.append(best[index][1])
+            continue
+        previous_end = merged[-1]['end'] if merged else 0.0
+        following = next((best[later][1] for later in range(index + 1, len(lines)) if later in best), None)
+        merged.append({
+            "start": previous_end,
+            "end": following['start'] if following else min(duration, previous_end + 2.0),
+            "text": line,
+            "language": merged[-1]['language'] if merged else (following or {}).get('language', ''),
+        })
+
+    return enforce_monotonic(merged, duration)
+
+def enforce_monotonic(matches: List[Dict], duration: float) -> List[Dict]:
+    """Clamp segments in lyric order so they never go backwards, overlap or pass the song's end."""
+    previous_end = 0.0
+    for match in matches:
+        start = min(max(float(match['start']), previous_end), duration)
+        end = min(max(float(match['end']), start), duration)
+        match['start'], match['end'] = round(start, 3), round(end, 3)
+        previous_end = end
+    return matches
+
+ONSET_FRAME_SECONDS = 0.01
+
+@lru_cache(maxsize=2)
+def _onset_strength_cached(audio_path: str, size: int, mtime_ns: int) -> np.ndarray:
+    envelope = energy_envelope(load_pcm(audio_path), PCM_SAMPLE_RATE, ONSET_FRAME_SECONDS)
+    # Log energy so quiet and loud passages produce comparable onsets; smoothing drops vibrato and consonant ripple
+    log_energy = _smooth(np.log10(envelope + 1e-4), 5)
+    flux = np.diff(log_energy, prepend=log_energy[:1]).astype(np.float32)
+    flux.flags.writeable = False
+    return flux
+
+def onset_strength(audio_path: str) -> np.ndarray:
+    """Change in log energy per 10 ms frame: peaks where sound starts, troughs where it stops.
+
+    Computed once per file and memoized for the most recent files.
+    """
+    audio_path = os.path.abspath(audio_path)
+    stat = os.stat(audio_path)
+    return _onset_strength_cached(audio_path, stat.st_size, stat.st_mtime_ns)
+
+def _snap(times: np.ndarray, strength: np.ndarray, radius: int, frame_seconds: float) -> np.ndarray:
+    positive = strength[strength > 0]
+    if len(positive) == 0 or len(times) == 0:
+        return times
+    # Only a clearly marked boundary is worth moving to
+    threshold = float(np.percentile(positive, 90))
+    offsets = np.arange(-radius, radius + 1)
+    # Prefer candidates close to the model's timestamp: weight falls to half at the window's edge
+    weights = 1.0 - 0.5 * np.abs(offsets) / max(1, radius)
+    centers = np.round(times / frame_seconds).astype(np.int64)
+    windows = np.clip(centers[:, None] + offsets[None, :], 0, len(strength) - 1)
+    best = windows[np.arange(len(times)), np.argmax(strength[windows] * weights, axis=1)]
+    return np.where(strength[best] >= threshold, best * frame_seconds, times)
+
+def snap_to_onsets(matches: List[Dict], flux: np.ndarray, duration: float, tolerance: float = 0.3,
+                   frame_seconds: float = ONSET_FRAME_SECONDS) -> List[Dict]:
+    """Move line starts to nearby onsets and ends to nearby decays, within tolerance seconds.
+
+    All boundaries are snapped at once. A boundary stays where it is when no
+    strong onset lies in its window, and an end that would land before its
+    start keeps its original time. Segments are then made monotonic.
+    """
+    if not matches:
+        return matches
+    radius = max(1, int(round(tolerance / frame_seconds)))
+    starts = np.array([float(match['start']) for match in matches])
+    ends = np.array([float(match['end']) for match in matches])
+    snapped_starts = _snap(starts, np.maximum(flux, 0), radius, frame_seconds)
+    snapped_ends = _snap(ends, np.maximum(-flux, 0), radius, frame_seconds)
+    snapped_ends = np.where(snapped_ends > snapped_starts, snapped_ends, np.maximum(ends, snapped_starts))
+
+    refined = [{**match, "start": float(start), "end": float(end)}
+               for match, start, end in zip(matches, snapped_starts, snapped_ends)]
+    return enforce_monotonic(refined, duration)
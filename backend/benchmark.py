@@ -0,0 +1,375 @@
+"""Offline benchmark for the match, prompt and image pipelines.
+
+Runs the real code paths end to end against a local stand-in for
+``genai.Client`` with configurable latency, over synthetic audio and lyrics
+of increasing size, so performance can be compared between commits without
+using API quota. Caches, debug files and config live in a temporary
+directory. Results (latency percentiles, throughput, per-stage time and
+memory) are written as JSON; pass ``--compare`` with an earlier result file
+to print the change in median latency per case.
+
+    python benchmark.py --iterations 20 --output results.json
+    python benchmark.py --only match --malformed --compare results.json
+"""
+import os
+import io
+import sys
+import json
+import math
+import time
+import wave
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable
+import numpy as np
+from PIL import Image
+
+import main as worker
+import metrics
+import utils
+import album_art
+import gemini_service
+from cache import UploadCache, ResultCache, ArtifactCache
+
+SAMPLE_RATE = 22050
+WORDS = "night light heart fire rain dream road home sky love time wind gold river stay fall".split()
+# 1x1 PNG, returned as the "generated" image
+GENERATED_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000100e221bc330000000049454e44ae426082'
+)
+
+def break_commas(text: str) -> str:
+    return text.replace('},\n', '}\n', 2)
+
+def trailing_commas(text: str) -> str:
+    return text.replace('"language": "en"', '"language": "en",')
+
+def unescaped_quotes(text: str) -> str:
+    return text.replace('"text": "', '"text": "say "hey" ', 3)
+
+def prose_around(text: str) -> str:
+    return f"Here are the timings you asked for:\n{text}\nLet me know if anything needs adjusting."
+
+def truncated(text: str) -> str:
+    return text[:int(len(text) * 0.9)]
+
+def single_quoted_keys(text: str) -> str:
+    return text.replace('"start"', "'start'").replace('"end"', "'end'")
+
+# Ways real responses have come back broken; each must still yield lyric objects
+MALFORMED_VARIANTS = {
+    "missing_commas": break_commas,
+    "trailing_commas": trailing_commas,
+    "unescaped_quotes": unescaped_quotes,
+    "prose_around": prose_around,
+    "truncated": truncated,
+    "single_quoted_keys": single_quoted_keys,
+}
+
+def fake_alignment(prompt: str) -> str:
+    """A plausible alignment for the lyrics and duration embedded in a match prompt."""
+    duration = float(prompt.split("duration is ", 1)[1].split(" seconds", 1)[0])
+    block = prompt.split("Lyrics lines:\n", 1)[1]
+    lines = json.JSONDecoder().raw_decode(block.lstrip())[0]
+    step = duration / max(1, len(lines))
+    matches = [{"start": round(i * step, 2), "end": round((i + 1) * step - 0.1, 2), "text": line, "language": "en"}
+               for i, line in enumerate(lines)]
+    return "```json\n" + json.dumps(matches, indent=2, ensure_ascii=False) + "\n```"
+
+class FakeFiles:
+    def __init__(self, client):
+        self.client = client
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def upload(self, file=None, **_):
+        time.sleep(self.client.upload_latency + os.path.getsize(file) / self.client.upload_bytes_per_second)
+        with self._lock:
+            self._count += 1
+            name = f"files/bench-{self._count}"
+        return SimpleNamespace(name=name, uri=f"https://example.invalid/{name}", mime_type=None,
+                               expiration_time=None)
+
+class FakeModels:
+    def __init__(self, client):
+        self.client = client
+        self._variant = 0
+        self._lock = threading.Lock()
+
+    def _sleep(self):
+        time.sleep(max(0.0, random.gauss(self.client.latency, self.client.latency * 0.1)))
+
+    def _alignment_text(self, prompt: str) -> str:
+        text = fake_alignment(prompt)
+        if not self.client.malformed:
+            return text
+        with self._lock:
+            name = list(MALFORMED_VARIANTS)[self._variant % len(MALFORMED_VARIANTS)]
+            self._variant += 1
+        return MALFORMED_VARIANTS[name](text)
+
+    def generate_content(self, model=None, contents=None, config=None):
+        self._sleep()
+        if isinstance(contents, str):
+            return SimpleNamespace(text="A quiet city at dusk, neon reflected in rain, soft gradients", candidates=[])
+        if isinstance(contents[1], Image.Image):
+            part = SimpleNamespace(inline_data=SimpleNamespace(mime_type='image/png', data=GENERATED_PNG))
+            return SimpleNamespace(text=None, candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+        return SimpleNamespace(text=self._alignment_text(contents[0]), candidates=[])
+
+    def generate_content_stream(self, model=None, contents=None, config=None):
+        text = self._alignment_text(contents[0])
+        pieces = max(1, len(text) // 64)
+        for index in range(pieces):
+            time.sleep(self.client.latency / pieces)
+            yield SimpleNamespace(text=text[index * 64:] if index == pieces - 1 else text[index * 64:(index + 1) * 64])
+
+class FakeClient:
+    """Stands in for genai.Client: files.upload and models.generate_content(_stream)."""
+
+    def __init__(self, latency: float = 0.2, upload_latency: float = 0.05,
+                 upload_bytes_per_second: float = 5 * 1024 * 1024, malformed: bool = False):
+        self.latency = latency
+        self.upload_latency = upload_latency
+        self.upload_bytes_per_second = upload_bytes_per_second
+        self.malformed = malformed
+        self.files = FakeFiles(self)
+        self.models = FakeModels(self)
+
+def write_synthetic_audio(path: str, seconds: float):
+    """Tone bursts separated by short gaps, roughly like sung phrases."""
+    rng = np.random.default_rng(int(seconds))
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    phrase = (np.floor(t / 4.0) % 2 == 0) | (t % 4.0 < 3.2)
+    tone = 0.3 * np.sin(2 * np.pi * (220 + 40 * np.floor(t / 4.0) % 200) * t) * phrase
+    samples = tone + 0.005 * rng.standard_normal(len(t))
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+def synthetic_lyrics(count: int) -> List[str]:
+    rng = random.Random(count)
+    lines = []
+    for index in range(count):
+        if index % 12 == 0:
+            lines.append(f"[Verse {index // 12 + 1}]")
+        lines.append(' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 9))))
+    return lines
+
+def write_synthetic_art(path: str, size: int):
+    gradient = np.linspace(0, 255, size, dtype=np.uint8)
+    pixels = np.stack(np.broadcast_arrays(gradient[None, :], gradient[:, None], np.uint8(128)), axis=-1)
+    Image.fromarray(pixels.astype(np.uint8), 'RGB').save(path, format='JPEG', quality=90)
+
+def isolate(workdir: str, client: FakeClient):
+    """Point config, caches and debug output at workdir and the client at the fake."""
+    config_path = os.path.join(workdir, 'config.json')
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump({"geminiApiKey": "benchmark", "debug": {"enabled": False}}, f)
+    cache_dir = os.path.join(workdir, 'cache')
+    gemini_service.CONFIG_PATH = config_path
+    gemini_service.get_client = lambda api_key=None: client
+    gemini_service.upload_cache = UploadCache(path=os.path.join(cache_dir, 'uploads.json'))
+    gemini_service.result_cache = ResultCache(path=os.path.join(cache_dir, 'results.sqlite3'))
+    gemini_service.artifact_cache = ArtifactCache(directory=os.path.join(cache_dir, 'artifacts'))
+    gemini_service.CHUNK_DIR = os.path.join(cache_dir, 'chunks')
+    utils.ENCODED_DIR = os.path.join(cache_dir, 'encoded')
+    utils.debug_sink.debug_dir = os.path.join(workdir, 'debug')
+    album_art.ART_DIR = os.path.join(cache_dir, 'album_art')
+    return cache_dir
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    low, high = math.floor(position), math.ceil(position)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+def run_case(name: str, fn: Callable, iterations: int, concurrency: int, reset: Callable = None) -> Dict:
+    """Time fn over several iterations, after two untimed warm-up runs, then measure its allocations once."""
+    # The first run takes the cache-miss paths and the second the first cache hits, which pay for lazy imports
+    fn()
+    fn()
+    latencies = []
+    spans: Dict[str, float] = {}
+    lock = threading.Lock()
+
+    def timed(_):
+        if reset:
+            reset()
+        started = time.perf_counter()
+        with metrics.trace(name) as trace:
+            fn()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            for span_name, entry in trace.spans.items():
+                spans[span_name] = spans.get(span_name, 0.0) + entry["seconds"]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(iterations)))
+    wall = time.perf_counter() - started
+
+    # tracemalloc slows allocation-heavy code down, so memory is measured on a separate run
+    if reset:
+        reset()
+    tracemalloc.start()
+    fn()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "case": name,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "throughput_per_second": round(iterations / wall, 3),
+        "latency_seconds": {
+            "mean": round(sum(latencies) / len(latencies), 6),
+            "min": round(min(latencies), 6),
+            "p50": round(percentile(latencies, 0.50), 6),
+            "p90": round(percentile(latencies, 0.90), 6),
+            "p99": round(percentile(latencies, 0.99), 6),
+            "max": round(max(latencies), 6),
+        },
+        "mean_span_seconds": {span_name: round(total / iterations, 6) for span_name, total in sorted(spans.items())},
+        "python_peak_bytes": traced_peak,
+        "peak_rss_bytes": metrics.peak_rss_bytes(),
+    }
+    return result
+
+def parse_cases(sizes: List[int]) -> List[Dict]:
+    """clean_gemini_response alone over well-formed and malformed responses of each size."""
+    cases = []
+    for size in sizes:
+        lines = [line for line in synthetic_lyrics(size) if not line.startswith('[')]
+        prompt = gemini_service.MATCH_PROMPT_TEMPLATE.format(duration=size * 3.0, lyrics=json.dumps(lines, indent=2))
+        responses = {"well_formed": fake_alignment(prompt)}
+        responses.update({name: variant(responses["well_formed"]) for name, variant in MALFORMED_VARIANTS.items()})
+        for variant_name, text in responses.items():
+            cases.append({"name": f"parse/{variant_name}/{size}_lines",
+                          "fn": lambda text=text: utils.clean_gemini_response(text)})
+    return cases
+
+def stream_match(audio_path: str, lyrics: List[str], model: str):
+    """Serve-mode streaming as the worker runs it: every line record, then the summary, serialized."""
+    output = io.StringIO()
+    summary = worker.match_lyrics_stream(audio_path, lyrics, model, lambda record: worker.write_json(record, output),
+                                       use_cache=False)
+    worker.write_json(summary, output)
+
+def build_cases(workdir: str, args) -> List[Dict]:
+    cases = []
+    for seconds, line_count in zip(args.durations, args.lines):
+        audio_path = os.path.join(workdir, f"audio_{int(seconds)}s.wav")
+        write_synthetic_audio(audio_path, seconds)
+        lyrics = synthetic_lyrics(line_count)
+        label = f"{int(seconds)}s_{line_count}_lines"
+        cases.append({"name": f"match/{label}", "fn": lambda a=audio_path, l=lyrics: worker.write_json(worker.match_lyrics(
+            a, l, args.model, use_cache=False), io.StringIO())})
+        cases.append({"name": f"match_stream/{label}", "fn": lambda a=audio_path, l=lyrics: stream_match(
+            a, l, args.model)})
+        if seconds > args.chunk_seconds * 1.5:
+            cases.append({"name": f"match_chunked/{label}", "fn": lambda a=audio_path, l=lyrics: worker.write_json(worker.match_lyrics(
+                a, l, args.model, use_cache=False, chunk_seconds=args.chunk_seconds), io.StringIO())})
+
+    for line_count in args.lines:
+        lyrics = synthetic_lyrics(line_count)
+        cases.append({"name": f"generate_prompt/{line_count}_lines", "fn": lambda l=lyrics: gemini_service.generate_prompt_with_gemini(
+            l, 'gemini-2.0-flash-lite', "Benchmark Song", use_cache=False)})
+
+    for size in args.art_sizes:
+        art_path = os.path.join(workdir, f"art_{size}.jpg")
+        write_synthetic_art(art_path, size)
+        cases.append({"name": f"generate_image/{size}px", "fn": lambda a=art_path: gemini_service.generate_image_with_gemini(
+            "soft neon rain", a, args.model, use_cache=False)})
+
+    cases.extend(parse_cases(args.lines))
+    return [case for case in cases if not args.only or any(case["name"].startswith(prefix) for prefix in args.only)]
+
+def compare(results: Dict, previous_path: str):
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = {case["case"]: case for case in json.load(f)["cases"]}
+    for case in results["cases"]:
+        before = previous.get(case["case"])
+        if not before:
+            continue
+        old, new = before["latency_seconds"]["p50"], case["latency_seconds"]["p50"]
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"{case['case']}: p50 {old * 1000:.1f} -> {new * 1000:.1f} ms ({change:+.1f}%)", file=sys.stderr)
+
+def setup_argparse():
+    parser = argparse.ArgumentParser(description='Benchmark the backend against a fake Gemini client.')
+    parser.add_argument('--iterations', type=int, default=10, help='Timed runs per case')
+    parser.add_argument('--concurrency', type=int, default=1, help='Runs of a case in flight at once')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds the fake model takes per call')
+    parser.add_argument('--upload-latency', type=float, default=0.05, help='Fixed seconds per fake upload')
+    parser.add_argument('--malformed', action='store_true', help='Make the fake model return broken JSON variants')
+    parser.add_argument('--cold', action='store_true', help='Clear all caches before every timed run')
+    parser.add_argument('--durations', type=float, nargs='+', default=[30, 180, 600], help='Synthetic audio lengths')
+    parser.add_argument('--lines', type=int, nargs='+', default=[10, 60, 200], help='Lyric line counts, paired with durations')
+    parser.add_argument('--art-sizes', type=int, nargs='+', default=[600, 3000], help='Album art edge lengths')
+    parser.add_argument('--chunk-seconds', type=float, default=120, help='Chunk length for the chunked match case')
+    parser.add_argument('--model', default='gemini-2.5-pro-exp-03-25', help='Model name passed through')
+    parser.add_argument('--only', nargs='+', help='Only run cases whose name starts with one of these')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results')
+    parser.add_argument('--compare', help='Earlier results file to compare median latency against')
+    return parser.parse_args()
+
+def main():
+    args = setup_argparse()
+    if len(args.durations) != len(args.lines):
+        raise SystemExit("--durations and --lines must have the same number of values")
+
+    metrics.registry.configure('off')
+    client = FakeClient(latency=args.latency, upload_latency=args.upload_latency, malformed=args.malformed)
+    workdir = tempfile.mkdtemp(prefix='lyrics-syncer-bench-')
+    results = {
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "settings": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        "cases": [],
+    }
+    # The services log every step; keep the benchmark's own output readable
+    service_log = io.StringIO()
+    try:
+        cache_dir = isolate(workdir, client)
+
+        def reset():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        for case in build_cases(workdir, args):
+            real_stderr = sys.stderr
+            sys.stderr = service_log
+            try:
+                result = run_case(case["name"], case["fn"], args.iterations, max(1, args.concurrency),
+                                  reset if args.cold else None)
+            finally:
+                sys.stderr = real_stderr
+                service_log.seek(0)
+                service_log.truncate()
+            latency = result["latency_seconds"]
+            print(f"{case['name']}: p50 {latency['p50'] * 1000:.1f} ms, p99 {latency['p99'] * 1000:.1f} ms, "
+                  f"{result['throughput_per_second']:.2f}/s", file=sys.stderr)
+            results["cases"].append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {len(results['cases'])} cases to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache')
+
+def write_json_atomic(path: str, data) -> None:
+    """Write JSON to a temporary file and move it into place so readers never see partial files."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def read_json(path: str, default):
+    """Read a JSON file, returning the default when it is missing or unreadable."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+class UploadCache:
+    """Gemini File API handles keyed by audio content hash.
+
+    Uploaded files stay available on Gemini for a limited time, so each entry
+    keeps the handle's expiry. Entries close to expiring are treated as
+    misses, and the index is bounded by evicting expired entries first and
+    then the least recently used ones.
+    """
+
+    # Gemini keeps uploaded files for 48 hours; used when the API gives no expiry
+    DEFAULT_TTL = 47 * 60 * 60
+
+    def __init__(self, path: str = None, max_entries: int = 64, expiry_margin: int = 10 * 60):
+        self.path = path or os.path.join(CACHE_DIR, 'uploads.json')
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict:
+        index = read_json(self.path, {})
+        index.setdefault('entries', {})
+        index.setdefault('stats', {'hits': 0, 'misses': 0})
+        return index
+
+    def _is_valid(self, entry: Dict, now: float) -> bool:
+        return entry.get('expires_at', 0) - self.expiry_margin > now
+
+    def _evict(self, entries: Dict, now: float) -> None:
+        for key in [key for key, entry in entries.items() if not self._is_valid(entry, now)]:
+            del entries[key]
+        if len(entries) > self.max_entries:
+            by_last_use = sorted(entries, key=lambda key: entries[key].get('last_used', 0))
+            for key in by_last_use[:len(entries) - self.max_entries]:
+                del entries[key]
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the cached handle for a key if it is still valid."""
+        with self._lock:
+            index = self._load()
+            now = time.time()
+            entry = index['entries'].get(key)
+            if entry and self._is_valid(entry, now):
+                entry['last_used'] = now
+                index['stats']['hits'] += 1
+                outcome = 'hit'
+            else:
+                entry = None
+                index['stats']['misses'] += 1
+                outcome = 'miss'
+            self._evict(index['entries'], now)
+            write_json_atomic(self.path, index)
+
+        stats = index['stats']
+        print(f"Upload cache {outcome} (hits: {stats['hits']}, misses: {stats['misses']})", file=sys.stderr)
+        return entry
+
+    def put(self, key: str, handle: Dict) -> None:
+        """Store a freshly uploaded file handle."""
+        with self._lock:
+            index = self._load()
+            now = time.time()
+            entry = dict(handle)
+            if not entry.get('expires_at'):
+                entry['expires_at'] = now + self.DEFAULT_TTL
+            entry['last_used'] = now
+            index['entries'][key] = entry
+            self._evict(index['entries'], now)
+            write_json_atomic(self.path, index)
+
+    def invalidate(self, key: str) -> None:
+        """Drop a handle that Gemini no longer accepts."""
+        with self._lock:
+            index = self._load()
+            if index['entries'].pop(key, None) is not None:
+                write_json_atomic(self.path, index)
+
+class ResultCache:
+    """Lyric matching results stored in SQLite.
+
+    Keys cover everything that decides the output of a match: the audio
+    content hash, the filtered lyric lines, the model and the prompt version.
+    The store is bounded by the total size of the stored results, evicting the
+    least recently used rows first.
+
+    Separately, the most recent alignment of each audio file is kept with the
+    lyrics it was made for, so edited lyrics can be realigned incrementally.
+    Only the max_latest most recently updated audio files are remembered.
+    """
+
+    def __init__(self, path: str = None, max_bytes: int = 64 * 1024 * 1024, max_latest: int = 1000):
+        self.path = path or os.path.join(CACHE_DIR, 'results.sqlite3')
+        self.max_bytes = max_bytes
+        self.max_latest = max_latest
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    @staticmethod
+    def make_key(audio_hash: str, lyrics: List[str], model_name: str, prompt_version: str) -> str:
+        payload = json.dumps([audio_hash, lyrics, model_name, prompt_version], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # The cache directory can be cleared while the worker is running
+        if not os.path.exists(self.path):
+            self._initialized = False
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created_at REAL NOT NULL, last_used REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS latest_alignments ('
+                'audio_hash TEXT PRIMARY KEY, lyrics TEXT NOT NULL, matches TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS latest_alignments_updated_at ON latest_alignments (updated_at)')
+            self._initialized = True
+        return conn
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        """Return the stored result for a key, or None."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    row = conn.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                    if row is None:
+                        return None
+                    conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+            finally:
+                conn.close()
+        return json.loads(row[0])
+
+    def put(self, key: str, value: List[Dict]) -> None:
+        """Store a result and evict old rows beyond the size bound."""
+        encoded = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+        size = len(encoded.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO results (key, value, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                        (key, encoded, size, now, now)
+                    )
+                    self._evict(conn)
+            finally:
+                conn.close()
+
+    def get_latest(self, audio_hash: str) -> Optional[Dict]:
+        """Return the last stored alignment of an audio file as {lyrics, matches}, or None."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                row = conn.execute('SELECT lyrics, matches FROM latest_alignments WHERE audio_hash = ?',
+                                   (audio_hash,)).fetchone()
+            finally:
+                conn.close()
+        if row is None:
+            return None
+        return {"lyrics": json.loads(row[0]), "matches": json.loads(row[1])}
+
+    def put_latest(self, audio_hash: str, lyrics: List[str], matches: List[Dict]) -> None:
+        """Remember the alignment of an audio file, replacing its previous one and dropping the oldest files."""
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO latest_alignments (audio_hash, lyrics, matches, updated_at) '
+                        'VALUES (?, ?, ?, ?)',
+                        (audio_hash, json.dumps(lyrics, ensure_ascii=False), json.dumps(matches, ensure_ascii=False),
+                         time.time())
+                    )
+                    conn.execute(
+                        'DELETE FROM latest_alignments WHERE audio_hash NOT IN '
+                        '(SELECT audio_hash FROM latest_alignments ORDER BY updated_at DESC LIMIT ?)',
+                        (self.max_latest,)
+                    )
+            finally:
+                conn.close()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute('SELECT key, size FROM results ORDER BY last_used').fetchall():
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+class ArtifactCache:
+    """Generated prompts and images stored as plain files named by their content key.
+
+    Each entry is the raw payload (``<key>.bin``) next to a small JSON file
+    with its metadata, such as the image MIME type. The directory is bounded
+    by total payload size, evicting the least recently used entries first;
+    hits refresh the payload's mtime, which serves as its last use time.
+    """
+
+    def __init__(self, directory: str = None, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory or os.path.join(CACHE_DIR, 'artifacts')
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        payload = json.dumps(parts, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _paths(self, key: str):
+        return os.path.join(self.directory, f"{key}.bin"), os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the entry's metadata with its payload ``path``, or None."""
+        data_path, meta_path = self._paths(key)
+        meta = read_json(meta_path, None)
+        if meta is None:
+            return None
+        try:
+            os.utime(data_path)
+        except OSError:
+            return None
+        return {**meta, "path": data_path}
+
+    def read(self, key: str) -> Optional[bytes]:
+        """Return the payload of an entry, or None."""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(entry['path'], 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, data: bytes, meta: Dict = None) -> str:
+        """Store a payload and return its path."""
+        data_path, meta_path = self._paths(key)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{data_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, data_path)
+            write_json_atomic(meta_path, {**(meta or {}), "size": len(data)})
+            self._evict(keep=data_path)
+        return data_path
+
+    def _evict(self, keep: str) -> None:
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.bin'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            for stale in (path, path[:-len('.bin')] + '.json'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            total -= size
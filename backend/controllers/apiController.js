@@ -2,13 +2,9 @@
 import fs from 'fs/promises';
 import * as fsSync from 'fs';
 import path from 'path';
-import { spawn } from 'child_process';
 import config from '../config/config.js';
 import { fileExists, getGeminiResultsPath, getSongName } from '../utils/fileUtils.js';
-
-// Get Python executable path from environment variable or use default
-// Always prefer the Python executable from the virtual environment
-const PYTHON_EXECUTABLE = process.env.PYTHON_EXECUTABLE || path.join(config.rootDir, '.venv', 'Scripts', 'python.exe');
+import { runPythonTask } from '../utils/pythonWorker.js';
 
 /**
  * Get API keys from config file
@@ -125,74 +121,68 @@ export const matchLyrics = async (req, res) => {
       size: fsSync.statSync(absoluteAudioPath).size
     });
 
-    // Prepare the command with cleaned audio path
-    const pythonArgs = [
-      config.pythonScriptPath,
-      '--mode', 'match',
-      '--audio', absoluteAudioPath,
-      '--lyrics', JSON.stringify(lyrics),
-      '--artist', artist,
-      '--song', song,
-      '--model', model
-    ];
-
-    const pythonProcess = spawn(PYTHON_EXECUTABLE, pythonArgs);
-
-    let stdoutData = '';
-    let stderrData = '';
-
-    pythonProcess.stdout.on('data', (data) => {
-      stdoutData += data.toString();
-      // Don't log the full stdout as it may contain large amounts of data
-      console.log('Python stdout received');
-    });
-
-    pythonProcess.stderr.on('data', (data) => {
-      stderrData += data.toString();
-      // Don't log the full stderr as it may contain large amounts of data
-      console.error('Python stderr received');
-    });
-
-    pythonProcess.on('close', (code) => {
-      if (code !== 0) {
-        console.error('Python process error occurred');
-        return res.status(500).json({
-          error: 'Failed to process lyrics',
-          status: 'error'
+    // Lines are forwarded as newline-delimited JSON as soon as the worker parses them
+    const writeMessage = (message) => {
+      if (!res.headersSent) {
+        res.setHeader('Content-Type', 'application/x-ndjson');
+      }
+      res.write(JSON.stringify(message) + '\n');
+    };
+    let matchedCount = 0;
+
+    let result;
+    try {
+      result = await runPythonTask('match', {
+        audio: absoluteAudioPath,
+        lyrics,
+        artist,
+        song,
+        model,
+        no_cache: Boolean(forceRematch),
+        stream: true
+      }, ({ type, ...line }) => {
+        matchedCount++;
+        writeMessage({ type: 'line', line });
+        writeMessage({
+          type: 'progress',
+          progress: Math.min(99, Math.round((matchedCount / lyrics.length) * 100)),
+          status: `Matched ${matchedCount} of ${lyrics.length} lines`
         });
+      });
+    } catch (error) {
+      console.error('Python process error occurred:', error.message);
+      if (res.headersSent) {
+        writeMessage({ type: 'error', error: 'Failed to process lyrics' });
+        return res.end();
       }
+      return res.status(500).json({
+        error: 'Failed to process lyrics',
+        status: 'error'
+      });
+    }
 
-      (async () => {
-        try {
-          const result = JSON.parse(stdoutData);
-
-          // Generate streaming response format
-          const streamedResult = {
-            type: 'result',
-            matchedLyrics: result.matched_lyrics || [],
-            language: result.detected_language || 'en',
-            status: result.status || 'success'
-          };
-
-          // Save original Gemini results to file only if not forceRematch
-          if (!forceRematch) {
-            await fs.writeFile(resultsPath, JSON.stringify(result, null, 2), 'utf-8');
-          }
+    // Generate streaming response format
+    const streamedResult = {
+      type: 'result',
+      matchedLyrics: result.matched_lyrics || [],
+      language: result.detected_language || 'en',
+      status: result.status || 'success'
+    };
 
-          // Return the reformatted result for the frontend
-          res.json(streamedResult);
-        } catch (error) {
-          console.error('Error parsing Python output:', error);
-          res.status(500).json({
-            type: 'error',
-            error: 'Failed to parse matching results',
-            status: 'error'
-          });
-        }
-      })();
-    });
+    // Save original Gemini results to file only if not forceRematch
+    if (!forceRematch) {
+      await fs.writeFile(resultsPath, JSON.stringify(result, null, 2), 'utf-8');
+    }
+
+    // Finish with the reformatted result for the frontend
+    writeMessage(streamedResult);
+    res.end();
   } catch (error) {
     console.error("Error in /api/match_lyrics:", error);
+    if (res.headersSent) {
+      res.write(JSON.stringify({ type: 'error', error: error.message }) + '\n');
+      return res.end();
+    }
     res.status(500).json({
       error: error.message,
       status: 'error'
@@ -270,17 +260,14 @@ export const generateImagePrompt = async (req, res) => {
       }
     }
 
-    const pythonArgs = [
-      config.pythonScriptPath,
-      '--mode', 'generate_prompt',
-      '--lyrics', JSON.stringify(lyrics),
-      '--model', model
-    ];
+    const params = {
+      lyrics,
+      model
+    };
 
     // Add album art path if available
     if (artPath) {
-      pythonArgs.push('--album_art');
-      pythonArgs.push(artPath);
+      params.album_art = artPath;
     }
 
     console.log('Running Python with args:', {
@@ -289,62 +276,16 @@ export const generateImagePrompt = async (req, res) => {
       hasAlbumArt: !!artPath
     });
 
-    const pythonProcess = spawn(PYTHON_EXECUTABLE, pythonArgs);
-
-    let stdoutData = '';
-    let stderrData = '';
-
-    pythonProcess.stdout.on('data', (data) => {
-      stdoutData += data.toString();
-      // Don't log the full stdout as it may contain large amounts of data
-      console.log('Python stdout received');
-    });
-
-    pythonProcess.stderr.on('data', (data) => {
-      stderrData += data.toString();
-      // Don't log the full stderr as it may contain large amounts of data
-      console.error('Python stderr received');
-    });
-
-    pythonProcess.on('close', (code) => {
-      if (code !== 0) {
-        console.error('Python process error occurred with code:', code);
-        console.error('Python stderr:', stderrData);
-
-        // Try to parse error from stderr if possible
-        let errorMessage = 'Failed to generate prompt';
-        try {
-          // Check if stderr contains JSON
-          if (stderrData.includes('{"error"')) {
-            const errorJson = stderrData.substring(stderrData.indexOf('{"error"'));
-            const parsedError = JSON.parse(errorJson);
-            errorMessage = parsedError.error || errorMessage;
-          }
-        } catch (parseError) {
-          console.error('Error parsing stderr JSON:', parseError);
-        }
-
-        return res.status(500).json({
-          error: errorMessage,
-          status: 'error',
-          details: stderrData
-        });
-      }
-
-      try {
-        const result = JSON.parse(stdoutData);
-        res.json(result);
-      } catch (error) {
-        console.error('Error parsing Python output:', error);
-        console.error('Python stdout:', stdoutData);
-        console.error('Python stderr:', stderrData);
-        res.status(500).json({
-          error: 'Failed to parse prompt generation results',
-          status: 'error',
-          details: error.message
-        });
-      }
-    });
+    try {
+      const result = await runPythonTask('generate_prompt', params);
+      res.json(result);
+    } catch (error) {
+      console.error('Python process error occurred:', error.message);
+      return res.status(500).json({
+        error: error.message || 'Failed to generate prompt',
+        status: 'error'
+      });
+    }
   } catch (error) {
     console.error('Error in generateImagePrompt:', error);
     res.status(500).json({ error: error.message });
@@ -407,51 +348,27 @@ export const generateImage = async (req, res) => {
       hasAlbumArt: !!artPath
     });
 
-    const pythonArgs = [
-      config.pythonScriptPath,
-      '--mode', 'generate_image',
-      '--prompt', prompt,
-      '--album_art', artPath,
-      '--model', model
-    ];
-
-    const pythonProcess = spawn(PYTHON_EXECUTABLE, pythonArgs);
-
-    let stdoutData = '';
-    let stderrData = '';
-
-    pythonProcess.stdout.on('data', (data) => {
-      stdoutData += data.toString();
-      // Don't log the full stdout as it may contain base64 image data
-      console.log('Python stdout received');
-    });
-
-    pythonProcess.stderr.on('data', (data) => {
-      stderrData += data.toString();
-      // Don't log the full stderr as it may contain large amounts of data
-      console.error('Python stderr received');
-    });
-
-    pythonProcess.on('close', (code) => {
-      if (code !== 0) {
-        console.error('Python process error occurred');
-        return res.status(500).json({
-          error: 'Failed to generate image',
-          status: 'error'
-        });
-      }
-
-      try {
-        const result = JSON.parse(stdoutData);
-        res.json(result);
-      } catch (error) {
-        console.error('Error parsing Python output:', error);
-        res.status(500).json({
-          error: 'Failed to parse image generation results',
-          status: 'error'
-        });
-      }
-    });
+    try {
+      // The worker only returns a small descriptor; the image bytes stay in a file
+      const result = await runPythonTask('generate_image', {
+        prompt,
+        album_art: artPath,
+        model,
+        image_output: 'path'
+      });
+      const imageBuffer = await fs.readFile(result.path);
+      res.json({
+        status: 'success',
+        data: imageBuffer.toString('base64'),
+        mime_type: result.mime_type
+      });
+    } catch (error) {
+      console.error('Python process error occurred:', error.message);
+      return res.status(500).json({
+        error: 'Failed to generate image',
+        status: 'error'
+      });
+    }
   } catch (error) {
     console.error('Error in generateImage:', error);
     res.status(500).json({ error: error.message });
@@ -1,31 +1,105 @@
+from __future__ import annotations
+
 import os
 import json
 import sys
-from datetime import datetime
-from typing import List, Dict
-import requests
-import io
-import base64
-from PIL import Image
-from google import genai
-from google.genai import types
-from utils import clean_gemini_response, save_debug_file, get_audio_duration
-
-def match_lyrics_with_gemini(audio_path: str, lyrics: List[str], model_name: str) -> List[Dict]:
-    """Match lyrics to audio using Gemini, uploading the audio via the File API."""
-    try:
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-
-        if not config.get('geminiApiKey'):
+import threading
+import hashlib
+import mimetypes
+import time
+import itertools
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from difflib import SequenceMatcher
+from typing import List, Dict, Iterator, Generator, TYPE_CHECKING
+from utils import (
+    clean_gemini_response, save_debug_file, debug_sink, get_audio_duration, hash_file,
+    preprocess_audio, normalize_lyrics, AUDIO_PREPROCESSING_DEFAULTS, LyricResponseParser
+)
+from cache import UploadCache, ResultCache, ArtifactCache
+from scheduler import model_limiter, coalescer, dispatcher, Lease
+import metrics
+
+# google.genai alone takes most of a second to import, numpy and PIL add more. They are
+# imported where first needed, so a cached match never loads them.
+if TYPE_CHECKING:
+    from google import genai
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.json')
+
+_config_lock = threading.Lock()
+_config_cache = {"mtime": None, "config": None}
+_clients = {}
+
+def load_config() -> Dict:
+    """Load config.json, re-reading it only when the file has changed on disk."""
+    mtime = os.path.getmtime(CONFIG_PATH)
+    with _config_lock:
+        if _config_cache["mtime"] != mtime:
+            with metrics.span('config_load'), open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+                _config_cache["config"] = json.load(f)
+            _config_cache["mtime"] = mtime
+        return _config_cache["config"]
+
+def get_api_keys() -> List[str]:
+    """The configured Gemini API keys: geminiApiKey followed by any in geminiApiKeys."""
+    config = load_config()
+    api_keys = [config.get('geminiApiKey'), *config.get('geminiApiKeys', [])]
+    return list(dict.fromkeys(api_key for api_key in api_keys if api_key))
+
+def get_client(api_key: str = None) -> genai.Client:
+    """Return a shared Gemini client for the given API key, by default the first configured one."""
+    if api_key is None:
+        api_keys = get_api_keys()
+        if not api_keys:
             raise ValueError("Gemini API key not found in config")
+        api_key = api_keys[0]
+
+    with _config_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            from google import genai
+            client = genai.Client(api_key=api_key)
+            _clients[api_key] = client
+        return client
+
+def _dispatch(model_name: str, attempt, label: str):
+    """Run attempt(lease) through the key dispatcher with the pool and budgets from config.json."""
+    dispatcher.configure(get_api_keys(), load_config().get('dispatcher', {}))
+    return dispatcher.run(model_name, attempt, get_client, label=label)
+
+upload_cache = UploadCache()
+result_cache = ResultCache()
+artifact_cache = ArtifactCache()
+
+def upload_audio(client: genai.Client, audio_path: str, cache_key: str):
+    """Upload audio through the File API, reusing a still-valid handle for identical content.
+
+    Returns the file reference to pass to generate_content and whether it came from the cache.
+    """
+    entry = upload_cache.get(cache_key)
+    if entry:
+        print(f"Reusing uploaded file {entry['name']}", file=sys.stderr)
+        from google.genai import types
+        return types.Part.from_uri(file_uri=entry['uri'], mime_type=entry['mime_type']), True
 
-        filtered_lyrics = [line for line in lyrics if not line.strip().startswith('[') and line.strip()]
+    try:
+        myfile = client.files.upload(file=audio_path)
+    except Exception as upload_error:
+        # Raised unchanged so the dispatcher sees rate limits and can fail over to another key
+        print(f"Error uploading file to Gemini File API: {upload_error}", file=sys.stderr)
+        raise
 
-        client = genai.Client(api_key=config['geminiApiKey'])
+    expiration_time = getattr(myfile, 'expiration_time', None)
+    upload_cache.put(cache_key, {
+        "name": myfile.name,
+        "uri": myfile.uri,
+        "mime_type": myfile.mime_type or mimetypes.guess_type(audio_path)[0] or 'audio/mpeg',
+        "expires_at": expiration_time.timestamp() if expiration_time else None
+    })
+    return myfile, False
 
-        prompt = f"""
+MATCH_PROMPT_TEMPLATE = """
 Task: Analyze the provided audio and match its content with the given lyrics lines. The audio may be in any language.
 
 Use this JSON schema for output:
@@ -40,43 +114,422 @@ Requirements:
 4. The 'text' field in your output MUST EXACTLY match the lines from 'Lyrics lines' below.
 5. The provided audio may be in any language. Analyze the audio content to determine timing.
 6. >>> CRITICAL: Detect and set the correct language code for each lyric line based on its content (e.g., 'ko' for Korean text).
-7. >>> CRITICAL information: This song's duration is {get_audio_duration(audio_path)} seconds, so think carefully about the last lyrics timing, it CANNOT BE LONGER.
+7. >>> CRITICAL information: This song's duration is {duration} seconds, so think carefully about the last lyrics timing, it CANNOT BE LONGER.
 8. If the provided lyrics have romanized Korean, turn it to actual Korean when responding.
 
 Lyrics lines:
-{json.dumps(filtered_lyrics, indent=2, ensure_ascii=False)}
+{lyrics}
 
 IMPORTANT: Your output must contain EXACTLY the same lines as provided in 'Lyrics lines' above, and the timing MUST come from analyzing the audio content. Return ONLY the JSON array following the schema, no other text.
 """
 
-        try:
-            myfile = client.files.upload(file=audio_path)
-        except Exception as upload_error:
-            raise RuntimeError(f"Error uploading file to Gemini File API: {upload_error}")
+SEGMENT_PROMPT_TEMPLATE = """
+Task: The provided audio is one segment of a longer song. Match its content with the given lyrics lines. The audio may be in any language.
+
+Use this JSON schema for output:
+LyricLine = {{'start': float, 'end': float, 'text': str, 'language': str}}
+For language field, use the correct language code (e.g., 'ko' for Korean, 'en' for English, 'ja' for Japanese).
+Return: list[LyricLine]
+
+Requirements:
+1. Each lyric line's timing must be derived directly from the audio, in seconds from the start of this segment. Each segment's duration cannot be too short, consider extending the end timing when there is still vocal playing.
+2. The lines below are the lyrics expected in this segment, in order. The first and last few may actually be sung just before or after it: leave out any line that is not sung in this audio.
+3. Output must be valid JSON with no extra text.
+4. The 'text' field in your output MUST EXACTLY match the lines from 'Lyrics lines' below, in the same order.
+5. >>> CRITICAL: Detect and set the correct language code for each lyric line based on its content (e.g., 'ko' for Korean text).
+6. >>> CRITICAL information: This segment's duration is {duration} seconds, no timing can be longer.
+7. If the provided lyrics have romanized Korean, turn it to actual Korean when responding.
+
+Lyrics lines:
+{lyrics}
+
+Return ONLY the JSON array following the schema, no other text.
+"""
 
-        if not model_name:
-            raise ValueError("Model name is required")
+# Changing the prompt changes the results, so cached results are tied to the template's hash
+MATCH_PROMPT_VERSION = hashlib.sha256(MATCH_PROMPT_TEMPLATE.encode('utf-8')).hexdigest()[:16]
+CHUNKED_PROMPT_VERSION = hashlib.sha256(SEGMENT_PROMPT_TEMPLATE.encode('utf-8')).hexdigest()[:16]
 
-        response = client.models.generate_content(
-            model=model_name,
-            contents=[prompt, myfile]
-        )
+CHUNK_DIR = os.path.join(os.path.dirname(__file__), 'cache', 'chunks')
 
-        response_text = response.text
+def get_preprocessing_settings() -> Dict:
+    """Audio preprocessing settings from config.json merged over the defaults."""
+    return {**AUDIO_PREPROCESSING_DEFAULTS, **load_config().get('audioPreprocessing', {})}
 
-        debug_dir = os.path.join(os.path.dirname(__file__), 'debug')
-        os.makedirs(debug_dir, exist_ok=True)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        prompt_file = save_debug_file(f'gemini_prompt_{timestamp}.txt', prompt)
-        debug_file = save_debug_file(f'gemini_response_{timestamp}.txt', response_text)
-        print(f"Debug files saved: {prompt_file}, {debug_file}", file=sys.stderr)
+ALIGNMENT_REFINEMENT_DEFAULTS = {
+    "enabled": True,
+    "toleranceSeconds": 0.3,
+}
 
-        cleaned_response = clean_gemini_response(response_text, debug_file)
-        matched_lyrics = json.loads(cleaned_response)
+def get_refinement_settings() -> Dict:
+    """Settings for snapping returned timestamps to onsets, from config.json merged over the defaults."""
+    return {**ALIGNMENT_REFINEMENT_DEFAULTS, **load_config().get('alignmentRefinement', {})}
 
-        cleaned_matches = []
-        for match in matched_lyrics:
-            cleaned_matches.append(dict(match))
+def _refine_matches(audio_path: str, matches: List[Dict], duration: float, onsets: Future = None) -> List[Dict]:
+    """Snap line boundaries to vocal onsets in the audio; returns the matches unchanged if that fails.
+
+    onsets is the audio's onset strength being computed in the background, see _start_onsets.
+    """
+    settings = get_refinement_settings()
+    if not settings["enabled"] or not matches:
+        return matches
+    try:
+        import alignment
+        with metrics.span('refine'):
+            flux = onsets.result() if onsets is not None else alignment.onset_strength(audio_path)
+            refined = alignment.snap_to_onsets(matches, flux, duration, tolerance=float(settings["toleranceSeconds"]))
+    except Exception as e:
+        print(f"Skipping timing refinement: {str(e)}", file=sys.stderr)
+        return matches
+    moved = sum(abs(new['start'] - float(old['start'])) > 0.005 for old, new in zip(matches, refined))
+    metrics.increment('refined_starts', moved)
+    return refined
+
+def _start_onsets(audio_path: str, pool: ThreadPoolExecutor):
+    """Decode the audio and compute its onset strength on pool, or return None when refinement is off."""
+    if not get_refinement_settings()["enabled"]:
+        return None
+
+    def compute():
+        import alignment
+        with metrics.span('onsets'):
+            return alignment.onset_strength(audio_path)
+
+    return pool.submit(contextvars.copy_context().run, compute)
+
+def _prepare_alignment(lease: Lease, audio_path: str, prompt_template: str, lines: List[str]) -> Dict:
+    """Preprocess and upload audio and build the alignment prompt for it.
+
+    The audio is preprocessed into a compact upload first; the prompt gets the
+    duration of what is actually uploaded, and ``offset`` is what returned
+    timestamps must be shifted by for any leading silence that was trimmed.
+    """
+    with metrics.span('preprocess'):
+        prepared = preprocess_audio(audio_path, get_preprocessing_settings())
+    upload_path = prepared["path"]
+    prompt = prompt_template.format(
+        duration=get_audio_duration(upload_path),
+        lyrics=json.dumps(lines, indent=2, ensure_ascii=False)
+    )
+
+    # Uploaded files are only visible to the project of the key that uploaded them
+    upload_key = f"{lease.key_id}:{hash_file(upload_path)}"
+    upload_started = time.perf_counter()
+    with metrics.span('upload'):
+        myfile, from_cache = upload_audio(lease.client, upload_path, upload_key)
+    metrics.add_bytes('audio_original', prepared["original_bytes"])
+    if not from_cache:
+        metrics.add_bytes('audio_uploaded', prepared["encoded_bytes"])
+        _report_upload(prepared, time.perf_counter() - upload_started)
+
+    return {
+        "prompt": prompt,
+        "file": myfile,
+        "from_cache": from_cache,
+        "upload_path": upload_path,
+        "upload_key": upload_key,
+        "offset": prepared["offset"],
+    }
+
+def _request_with_upload(client: genai.Client, request: Dict, call):
+    """Run call(audio_file), uploading again once if Gemini rejects a cached handle."""
+    try:
+        return call(request["file"])
+    except Exception as generate_error:
+        # A cached handle can be deleted on Gemini's side before its expiry
+        if not request["from_cache"] or getattr(generate_error, 'code', None) not in (400, 403, 404):
+            raise
+        print(f"Cached upload rejected ({generate_error}), uploading again", file=sys.stderr)
+        upload_cache.invalidate(request["upload_key"])
+        request["file"], request["from_cache"] = upload_audio(client, request["upload_path"], request["upload_key"])
+        return call(request["file"])
+
+def _save_alignment_debug(prompt: str, response_text: str) -> str:
+    debug_sink.configure(**load_config().get('debug', {}))
+    debug_id = debug_sink.new_id()
+    prompt_file = save_debug_file(f'gemini_prompt_{debug_id}.txt', prompt)
+    debug_file = save_debug_file(f'gemini_response_{debug_id}.txt', response_text)
+    if debug_file:
+        print(f"Debug files queued: {prompt_file}, {debug_file}", file=sys.stderr)
+    return debug_file
+
+def _shift_match(match: Dict, offset: float) -> Dict:
+    """Shift a freshly parsed match, in place, from upload time to original audio time."""
+    if offset:
+        match["start"] = round(float(match["start"]) + offset, 3)
+        match["end"] = round(float(match["end"]) + offset, 3)
+    return match
+
+def _align_audio(audio_path: str, prompt_template: str, lines: List[str], model_name: str) -> List[Dict]:
+    """Upload audio, ask the model for an alignment and parse it into a list of matches."""
+    if not model_name:
+        raise ValueError("Model name is required")
+
+    def attempt(lease: Lease):
+        request = _prepare_alignment(lease, audio_path, prompt_template, lines)
+
+        def generate(audio_file):
+            with model_limiter.slot(lease.model):
+                return lease.client.models.generate_content(
+                    model=lease.model,
+                    contents=[request["prompt"], audio_file]
+                )
+
+        with metrics.span('generate_content'):
+            response = _request_with_upload(lease.client, request, generate)
+        lease.record_usage(response)
+        return request, response
+
+    request, response = _dispatch(model_name, attempt, label=f'{model_name} generate_content')
+    response_text = response.text
+    metrics.add_bytes('response', len(response_text.encode('utf-8')))
+    debug_file = _save_alignment_debug(request["prompt"], response_text)
+
+    matched_lyrics = clean_gemini_response(response_text, debug_file)
+    return [_shift_match(match, request["offset"]) for match in matched_lyrics]
+
+def _stream_alignment(audio_path: str, prompt_template: str, lines: List[str],
+                      model_name: str) -> Iterator[Dict]:
+    """Like _align_audio, but yield each match as soon as the streamed response completes it."""
+    if not model_name:
+        raise ValueError("Model name is required")
+
+    def attempt(lease: Lease):
+        request = _prepare_alignment(lease, audio_path, prompt_template, lines)
+
+        def open_stream(audio_file):
+            stream = lease.client.models.generate_content_stream(
+                model=lease.model,
+                contents=[request["prompt"], audio_file]
+            )
+            # The request is only sent on the first iteration, so errors surface here where they can be retried
+            first_chunk = next(stream, None)
+            return itertools.chain([first_chunk] if first_chunk is not None else [], stream)
+
+        return lease, request, _request_with_upload(lease.client, request, open_stream)
+
+    parser = LyricResponseParser()
+    response_parts = []
+    with model_limiter.slot(model_name):
+        lease, request, stream = _dispatch(model_name, attempt, label=f'{model_name} generate_content_stream')
+        chunk = None
+        for chunk in stream:
+            text = chunk.text or ''
+            response_parts.append(text)
+            metrics.add_bytes('response', len(text.encode('utf-8')))
+            for match in parser.feed(text):
+                yield _shift_match(match, request["offset"])
+        for match in parser.close():
+            yield _shift_match(match, request["offset"])
+        # The last chunk carries the token count for the whole response
+        lease.record_usage(chunk)
+
+    _save_alignment_debug(request["prompt"], ''.join(response_parts))
+    if parser.repairs:
+        print(f"Repaired streamed Gemini response: {dict(parser.repairs)}", file=sys.stderr)
+
+def _report_upload(prepared: Dict, upload_seconds: float) -> None:
+    """Print how much the preprocessing saved on the upload."""
+    original_mb = prepared["original_bytes"] / (1024 * 1024)
+    encoded_mb = prepared["encoded_bytes"] / (1024 * 1024)
+    if prepared["encoded_bytes"] == prepared["original_bytes"]:
+        print(f"Uploaded {encoded_mb:.2f} MB in {upload_seconds:.1f}s", file=sys.stderr)
+        return
+    # Estimate the full-size upload from the throughput just measured
+    full_upload_seconds = upload_seconds * prepared["original_bytes"] / max(1, prepared["encoded_bytes"])
+    saved_seconds = full_upload_seconds - upload_seconds - prepared["encode_seconds"]
+    print(f"Uploaded {encoded_mb:.2f} MB instead of {original_mb:.2f} MB in {upload_seconds:.1f}s "
+          f"(encoding {prepared['encode_seconds']:.1f}s{', cached' if prepared['cached'] else ''}, "
+          f"about {saved_seconds:.1f}s saved)", file=sys.stderr)
+
+def _align_slice(pcm, audio_hash: str, start: float, end: float, lines: List[str], model_name: str) -> List[Dict]:
+    """Align the lines to a slice of decoded audio, written to a WAV file only for as long as that takes.
+
+    Matches are in slice time. The uploaded encoding of the slice stays in the
+    preprocessing cache, keyed by its content, so the WAV itself is not kept.
+    """
+    import alignment
+
+    # Unique per thread, so concurrent requests on the same audio never share or delete each other's slice
+    chunk_path = os.path.join(CHUNK_DIR,
+                              f"{audio_hash}_{start:.2f}_{end:.2f}_{os.getpid()}_{threading.get_ident()}.wav")
+    alignment.write_wav_chunk(pcm, alignment.PCM_SAMPLE_RATE, start, end, chunk_path)
+    try:
+        return _align_audio(chunk_path, SEGMENT_PROMPT_TEMPLATE, lines, model_name)
+    finally:
+        try:
+            os.remove(chunk_path)
+        except OSError:
+            pass
+
+def _match_chunked(audio_path: str, audio_hash: str, filtered_lyrics: List[str],
+                   model_name: str, chunk_seconds: float, overlap_lines: int = 2) -> List[Dict]:
+    """Split long audio at quiet points, align the chunks concurrently and merge them."""
+    import alignment
+
+    pcm = alignment.load_pcm(audio_path)
+    duration = len(pcm) / alignment.PCM_SAMPLE_RATE
+    envelope = alignment.energy_envelope(pcm)
+    split_points = alignment.find_split_points(envelope, target_seconds=chunk_seconds)
+    bounds = [0.0] + split_points + [duration]
+    chunks = list(zip(bounds[:-1], bounds[1:]))
+    core_ranges = alignment.assign_lyric_ranges(len(filtered_lyrics), chunks, envelope)
+    print(f"Aligning {len(chunks)} chunks at {', '.join(f'{point:.1f}s' for point in split_points) or 'no split points'}",
+          file=sys.stderr)
+
+    def align_chunk(index: int) -> Dict:
+        start, end = chunks[index]
+        core_start, core_end = core_ranges[index]
+        context = (max(0, core_start - overlap_lines), min(len(filtered_lyrics), core_end + overlap_lines))
+        result = {"offset": start, "core": (core_start, core_end), "context": context, "matches": []}
+        if context[0] == context[1]:
+            return result
+
+        result["matches"] = _align_slice(pcm, audio_hash, start, end,
+                                         filtered_lyrics[context[0]:context[1]], model_name)
+        return result
+
+    # Run each chunk in a copy of this context so its spans land in the current trace
+    contexts = [contextvars.copy_context() for _ in chunks]
+    with ThreadPoolExecutor(max_workers=min(len(chunks), 4)) as pool:
+        chunk_results = list(pool.map(lambda index: contexts[index].run(align_chunk, index), range(len(chunks))))
+
+    return alignment.merge_chunk_alignments(filtered_lyrics, chunk_results, duration)
+
+def _match_incremental(audio_path: str, audio_hash: str, filtered_lyrics: List[str],
+                       model_name: str, previous: Dict, duration: float, anchor_lines: int = 2,
+                       max_changed_fraction: float = 0.5) -> List[Dict]:
+    """Realign only the lines that differ from a previous alignment of the same audio.
+
+    Unchanged lines keep their timings. Each changed run of lines is aligned
+    on the audio between its unchanged neighbours, with up to anchor_lines of
+    them on each side as context. Returns None when nothing or too much
+    changed, in which case the whole song should be aligned.
+    """
+    old_lines, old_matches = previous["lyrics"], previous["matches"]
+    if len(old_lines) != len(old_matches):
+        return None
+    opcodes = SequenceMatcher(None, old_lines, filtered_lyrics, autojunk=False).get_opcodes()
+    changed_lines = [index for tag, _, _, j1, j2 in opcodes if tag != 'equal' for index in range(j1, j2)]
+    changed_count = sum(max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in opcodes if tag != 'equal')
+    if not changed_count or changed_count > max_changed_fraction * max(len(filtered_lyrics), 1):
+        return None
+
+    import alignment
+
+    chunk_results = []
+    windows = []
+    for position, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag == 'equal':
+            chunk_results.append({"offset": 0.0, "core": (j1, j2), "context": (j1, j2), "matches": old_matches[i1:i2]})
+        elif j2 > j1:
+            # Anchors come only from the unchanged runs right next to this one, which have the same
+            # length in the old and the new lyrics
+            before = after = 0
+            if position > 0 and opcodes[position - 1][0] == 'equal':
+                before = min(anchor_lines, opcodes[position - 1][2] - opcodes[position - 1][1])
+            if position + 1 < len(opcodes) and opcodes[position + 1][0] == 'equal':
+                after = min(anchor_lines, opcodes[position + 1][2] - opcodes[position + 1][1])
+            start = old_matches[i1 - before]["start"] if before else 0.0
+            end = old_matches[i2 + after - 1]["end"] if after else duration
+            # A little slack for lines sung right at the edges, and enough audio for the model to work with
+            start, end = max(0.0, start - 1.0), min(duration, end + 1.0)
+            if end - start < 8.0:
+                center = (start + end) / 2
+                start, end = max(0.0, center - 4.0), min(duration, center + 4.0)
+            windows.append({"offset": start, "end": end, "core": (j1, j2), "context": (j1 - before, j2 + after)})
+
+    window_seconds = sum(window["end"] - window["offset"] for window in windows)
+    print(f"Realigning {len(changed_lines)} changed lines in {len(windows)} windows "
+          f"({window_seconds:.1f}s of {duration:.1f}s audio)", file=sys.stderr)
+    metrics.increment('incremental_lines', len(changed_lines))
+
+    pcm = alignment.load_pcm(audio_path)
+
+    def align_window(window: Dict) -> Dict:
+        context_start, context_end = window["context"]
+        matches = _align_slice(pcm, audio_hash, window["offset"], window["end"],
+                               filtered_lyrics[context_start:context_end], model_name)
+        return {**window, "matches": matches}
+
+    if windows:
+        contexts = [contextvars.copy_context() for _ in windows]
+        with ThreadPoolExecutor(max_workers=min(len(windows), 4)) as pool:
+            chunk_results.extend(pool.map(lambda index: contexts[index].run(align_window, windows[index]),
+                                          range(len(windows))))
+
+    merged = alignment.merge_chunk_alignments(filtered_lyrics, chunk_results, duration)
+    refined = _refine_matches(audio_path, [merged[index] for index in changed_lines], duration)
+    changed = set(changed_lines)
+    # Merging can nudge unchanged lines to make room; they keep their previous timings instead
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            merged[j1:j2] = [dict(match) for match in old_matches[i1:i2]]
+    for index, match in zip(changed_lines, refined):
+        # Changed lines have to fit between their unchanged neighbours
+        lower = next((merged[i]["end"] for i in range(index - 1, -1, -1) if i not in changed), 0.0)
+        upper = next((merged[i]["start"] for i in range(index + 1, len(merged)) if i not in changed), duration)
+        match["start"] = min(max(match["start"], lower), upper)
+        match["end"] = min(max(match["end"], match["start"]), upper)
+        merged[index] = match
+    return alignment.enforce_monotonic(merged, duration)
+
+def _match_cache_key(audio_path: str, filtered_lyrics: List[str], model_name: str, chunked: bool,
+                     chunk_seconds: float = None) -> str:
+    prompt_version = f"{CHUNKED_PROMPT_VERSION}:{chunk_seconds}" if chunked else MATCH_PROMPT_VERSION
+    # What gets uploaded and how timings are refined change the result as much as the prompt does
+    prompt_version += ':' + json.dumps(get_preprocessing_settings(), sort_keys=True)
+    prompt_version += ':' + json.dumps(get_refinement_settings(), sort_keys=True)
+    return ResultCache.make_key(hash_file(audio_path), filtered_lyrics, model_name, prompt_version)
+
+def match_lyrics_with_gemini(audio_path: str, lyrics: List[str], model_name: str, use_cache: bool = True,
+                             chunk_seconds: float = None, incremental: bool = True) -> List[Dict]:
+    """Match lyrics to audio using Gemini, uploading the audio via the File API.
+
+    Results are cached on disk; with use_cache=False the lookup is skipped and
+    the fresh result replaces any stored one. With chunk_seconds set, audio
+    longer than that is split at quiet points into chunks of about that length
+    which are aligned in parallel. With incremental set, lyrics that differ in
+    a few lines from the last alignment of the same audio only have those
+    lines realigned.
+    """
+    try:
+        filtered_lyrics, _ = normalize_lyrics(lyrics)
+
+        duration = get_audio_duration(audio_path)
+        chunked = bool(chunk_seconds) and duration > chunk_seconds * 1.5
+        result_key = _match_cache_key(audio_path, filtered_lyrics, model_name, chunked, chunk_seconds)
+        if use_cache:
+            with metrics.span('result_cache'):
+                cached_matches = result_cache.get(result_key)
+            if cached_matches is not None:
+                metrics.increment('result_cache_hit')
+                print(f"Using cached match result ({len(cached_matches)} lines)", file=sys.stderr)
+                return cached_matches
+
+        audio_hash = hash_file(audio_path)
+
+        cleaned_matches = None
+        previous = result_cache.get_latest(audio_hash) if use_cache and incremental else None
+        if previous:
+            try:
+                cleaned_matches = _match_incremental(audio_path, audio_hash, filtered_lyrics, model_name,
+                                                     previous, duration)
+            except Exception as e:
+                print(f"Incremental realignment failed ({str(e)}), aligning the whole song", file=sys.stderr)
+                cleaned_matches = None
+
+        if cleaned_matches is None:
+            if chunked:
+                cleaned_matches = _match_chunked(audio_path, audio_hash, filtered_lyrics,
+                                                 model_name, chunk_seconds)
+            else:
+                cleaned_matches = _align_audio(audio_path, MATCH_PROMPT_TEMPLATE, filtered_lyrics, model_name)
+            cleaned_matches = _refine_matches(audio_path, cleaned_matches, duration)
+
+        if cleaned_matches:
+            result_cache.put(result_key, cleaned_matches)
+            result_cache.put_latest(audio_hash, filtered_lyrics, cleaned_matches)
 
         return cleaned_matches
 
@@ -84,7 +537,70 @@ IMPORTANT: Your output must contain EXACTLY the same lines as provided in 'Lyric
         print(f"Error matching lyrics with Gemini: {str(e)}", file=sys.stderr)
         raise
 
-def generate_prompt_with_gemini(lyrics, model_name, song_name):
+def stream_lyrics_with_gemini(audio_path: str, lyrics: List[str], model_name: str, use_cache: bool = True,
+                              incremental: bool = True) -> Generator[Dict, None, List[Dict]]:
+    """Match lyrics to audio like match_lyrics_with_gemini, yielding each line as soon as it is parsed.
+
+    Lines come in the order the model produces them. The complete, sorted
+    result is stored in the result cache and is the generator's return value,
+    so a caller can report exactly what a later cache hit replays. Edits of a
+    few lines are realigned incrementally and replayed at once.
+    """
+    try:
+        filtered_lyrics, _ = normalize_lyrics(lyrics)
+
+        result_key = _match_cache_key(audio_path, filtered_lyrics, model_name, chunked=False)
+        if use_cache:
+            with metrics.span('result_cache'):
+                cached_matches = result_cache.get(result_key)
+            if cached_matches is not None:
+                metrics.increment('result_cache_hit')
+                print(f"Using cached match result ({len(cached_matches)} lines)", file=sys.stderr)
+                yield from cached_matches
+                return cached_matches
+
+        duration = get_audio_duration(audio_path)
+        audio_hash = hash_file(audio_path)
+        previous = result_cache.get_latest(audio_hash) if use_cache and incremental else None
+        if previous:
+            try:
+                matches = _match_incremental(audio_path, audio_hash, filtered_lyrics, model_name, previous, duration)
+            except Exception as e:
+                print(f"Incremental realignment failed ({str(e)}), aligning the whole song", file=sys.stderr)
+                matches = None
+            if matches:
+                result_cache.put(result_key, matches)
+                result_cache.put_latest(audio_hash, filtered_lyrics, matches)
+                yield from matches
+                return matches
+
+        matches = []
+        previous_end = 0.0
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # Decoding the audio for refinement overlaps the upload and the model's first tokens
+            onsets = _start_onsets(audio_path, pool)
+            for match in _stream_alignment(audio_path, MATCH_PROMPT_TEMPLATE, filtered_lyrics, model_name):
+                matches.append(match)
+                # Each line is refined on its own as it arrives and kept after the lines already sent;
+                # the stored result is refined as a whole, the same way as a non-streamed match
+                line = dict(_refine_matches(audio_path, [dict(match)], duration, onsets)[0])
+                line["start"] = round(min(max(float(line["start"]), previous_end), duration), 3)
+                line["end"] = round(min(max(float(line["end"]), line["start"]), duration), 3)
+                previous_end = line["end"]
+                yield line
+
+            if matches:
+                matches = _refine_matches(audio_path, sorted(matches, key=lambda match: match["start"]),
+                                          duration, onsets)
+                result_cache.put(result_key, matches)
+                result_cache.put_latest(audio_hash, filtered_lyrics, matches)
+        return matches
+
+    except Exception as e:
+        print(f"Error streaming lyrics match with Gemini: {str(e)}", file=sys.stderr)
+        raise
+
+def generate_prompt_with_gemini(lyrics, model_name, song_name, use_cache=True):
     """Generate image prompt from lyrics using Gemini."""
     try:
         VALID_PROMPT_MODELS = [
@@ -95,16 +611,15 @@ def generate_prompt_with_gemini(lyrics, model_name, song_name):
         if model_name not in VALID_PROMPT_MODELS:
             raise ValueError(f"Invalid prompt generation model. Must be one of: {', '.join(VALID_PROMPT_MODELS)}")
 
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-
-        if not config.get('geminiApiKey'):
-            raise ValueError("Gemini API key not found in config")
+        cache_key = ArtifactCache.make_key('prompt', lyrics, song_name, model_name)
+        if use_cache:
+            cached = artifact_cache.read(cache_key)
+            if cached is not None:
+                print("Using cached image prompt", file=sys.stderr)
+                return {"prompt": cached.decode('utf-8'), "model": model_name, "status": "success"}
 
-        client = genai.Client(api_key=config['geminiApiKey'])
-
-        prompt = f"""
+        def generate() -> str:
+            prompt = f"""
 song title: {song_name}
 
 {lyrics}
@@ -112,86 +627,93 @@ song title: {song_name}
 generate one prompt to put in a image generator to describe the atmosphere/object of this song, should be simple but abstract because I will use this image as youtube video background for a lyrics video, return the prompt only, no extra texts
 """
 
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt
-        )
+            def attempt(lease: Lease):
+                with metrics.span('generate_content'):
+                    response = lease.client.models.generate_content(
+                        model=lease.model,
+                        contents=prompt
+                    )
+                lease.record_usage(response)
+                return response
+
+            response = _dispatch(model_name, attempt, label=f'{model_name} generate_content')
+            artifact_cache.put(cache_key, response.text.encode('utf-8'), {"model": model_name})
+            return response.text
 
         result = {
-            "prompt": response.text,
+            "prompt": coalescer.run(cache_key, generate),
             "model": model_name,
             "status": "success"
         }
 
-        print(json.dumps(result), file=sys.stdout)
-
         return result
 
     except Exception as e:
         print(f"Error generating prompt with Gemini: {str(e)}", file=sys.stderr)
         raise
 
-def generate_image_with_gemini(prompt, album_art_url, model_name):
-    """Generate image using prompt and album art with Gemini."""
-    try:
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-
-        if not config.get('geminiApiKey'):
-            raise ValueError("Gemini API key not found in config")
-
-        client = genai.Client(api_key=config['geminiApiKey'])
+def generate_image_with_gemini(prompt, album_art_url, model_name, use_cache=True):
+    """Generate image using prompt and album art with Gemini.
 
-        final_prompt = f"Expand the image into 16:9 ratio (landscape ratio). Then decorate my given image with {prompt}"
+    Returns the generated image's cache entry: its ``path`` on disk and its
+    ``mime_type``. Identical prompt, album art and model reuse the stored image.
+    """
+    from google.genai import types
+    from album_art import album_art_path, load_album_art
 
-        if isinstance(album_art_url, str) and album_art_url.startswith('data:'):
-            base64_data = album_art_url.split(',')[1]
-            image_bytes = base64.b64decode(base64_data)
-            image = Image.open(io.BytesIO(image_bytes))
-        elif os.path.exists(album_art_url):
-            print(f"Using local album art file: {album_art_url}", file=sys.stderr)
-            with open(album_art_url, 'rb') as f:
-                image_bytes = f.read()
-                image = Image.open(io.BytesIO(image_bytes))
-        else:
-            try:
-                print(f"Attempting to download album art from URL: {album_art_url}", file=sys.stderr)
-                response = requests.get(album_art_url)
-                if response.status_code != 200:
-                    raise ValueError("Failed to download album art")
-                image = Image.open(io.BytesIO(response.content))
-            except Exception as download_error:
-                print(f"Error downloading album art: {str(download_error)}", file=sys.stderr)
-                raise ValueError(f"Failed to download album art: {str(download_error)}")
-
-        response = client.models.generate_content(
-            model=model_name,
-            contents=[final_prompt, image],
-            config=types.GenerateContentConfig(response_modalities=["Text", "Image"])
-        )
-
-        image_part = None
-        if hasattr(response, 'candidates'):
-            for candidate in response.candidates:
-                if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'inline_data') and part.inline_data.mime_type.startswith('image/'):
-                            image_part = part
-                            break
-                if image_part:
-                    break
-
-        if not image_part:
-            raise ValueError("No image was generated in the response")
-
-        image_bytes = image_part.inline_data.data
-        # Don't print debug info about the image data to avoid cluttering the terminal
-        return {
-            "data": base64.b64encode(image_bytes).decode('utf-8'),
-            "mime_type": image_part.inline_data.mime_type
-        }
+    try:
+        try:
+            with metrics.span('album_art'):
+                art_path = album_art_path(album_art_url)
+        except Exception as load_error:
+            print(f"Error loading album art: {str(load_error)}", file=sys.stderr)
+            raise ValueError(f"Failed to load album art: {str(load_error)}")
+
+        cache_key = ArtifactCache.make_key('image', prompt, hash_file(art_path), model_name)
+        if use_cache:
+            cached = artifact_cache.get(cache_key)
+            if cached is not None:
+                print("Using cached generated image", file=sys.stderr)
+                return cached
+
+        def generate() -> Dict:
+            final_prompt = f"Expand the image into 16:9 ratio (landscape ratio). Then decorate my given image with {prompt}"
+            image = load_album_art(art_path)
+
+            def attempt(lease: Lease):
+                with metrics.span('generate_content'):
+                    response = lease.client.models.generate_content(
+                        model=lease.model,
+                        contents=[final_prompt, image],
+                        config=types.GenerateContentConfig(response_modalities=["Text", "Image"])
+                    )
+                lease.record_usage(response)
+                return response
+
+            response = _dispatch(model_name, attempt, label=f'{model_name} generate_content')
+
+            image_part = None
+            if hasattr(response, 'candidates'):
+                for candidate in response.candidates:
+                    if hasattr(candidate, 'content') and hasattr(candidate.content, 'parts'):
+                        for part in candidate.content.parts:
+                            if hasattr(part, 'inline_data') and part.inline_data.mime_type.startswith('image/'):
+                                image_part = part
+                                break
+                    if image_part:
+                        break
+
+            if not image_part:
+                raise ValueError("No image was generated in the response")
+
+            mime_type = image_part.inline_data.mime_type
+            metrics.add_bytes('image', len(image_part.inline_data.data))
+            path = artifact_cache.put(cache_key, image_part.inline_data.data,
+                                      {"mime_type": mime_type, "model": model_name})
+            return {"path": path, "mime_type": mime_type}
+
+        return coalescer.run(cache_key, generate)
 
     except Exception as e:
         print(f"Error generating image with Gemini: {str(e)}", file=sys.stderr)
-        raise
\ No newline at end of file
+        raise
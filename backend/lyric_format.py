@@ -0,0 +1,111 @@
+from typing import List, Dict
+from utils import convert_time_to_seconds
+
+# Timings may run this far past the end of the audio before they count as out of range
+DURATION_TOLERANCE = 0.05
+
+def _seconds(value, field: str) -> float:
+    if isinstance(value, str):
+        try:
+            return convert_time_to_seconds(value.strip())
+        except ValueError:
+            raise ValueError(f"'{field}' must be a number of seconds, got {value!r}")
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"'{field}' must be a number of seconds, got {value!r}")
+    return float(value)
+
+class LyricLine:
+    """One aligned lyric line with its times in seconds."""
+
+    __slots__ = ('start', 'end', 'text', 'language')
+
+    def __init__(self, start: float, end: float, text: str, language: str = ''):
+        self.start = start
+        self.end = end
+        self.text = text
+        self.language = language
+
+    @classmethod
+    def from_dict(cls, item: Dict) -> 'LyricLine':
+        """Build a line from a match dict, raising ValueError if a field is missing or has the wrong type."""
+        missing = [field for field in ('start', 'end', 'text') if field not in item]
+        if missing:
+            raise ValueError(f"Lyric line is missing {', '.join(missing)}: {item!r}")
+        text = item['text']
+        if not isinstance(text, str):
+            raise ValueError(f"'text' must be a string, got {text!r}")
+        return cls(_seconds(item['start'], 'start'), _seconds(item['end'], 'end'), text,
+                   item.get('language') or '')
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, LyricLine):
+            return NotImplemented
+        return (self.start, self.end, self.text, self.language) == (other.start, other.end, other.text, other.language)
+
+    def __repr__(self) -> str:
+        return f"LyricLine({self.start!r}, {self.end!r}, {self.text!r}, {self.language!r})"
+
+def _clock(seconds: float, separator: str) -> str:
+    """hh:mm:ss plus milliseconds after separator, as SRT (',') and WebVTT ('.') write them."""
+    millis = int(round(max(0.0, seconds) * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    seconds, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{millis:03d}"
+
+def timing_problems(matches: List[Dict], duration: float = None) -> List[str]:
+    """Describe every timing that runs backwards, overlaps the previous line or leaves the audio."""
+    problems = []
+    limit = duration + DURATION_TOLERANCE if duration is not None else None
+    previous_end = 0.0
+    for index, match in enumerate(matches):
+        start, end = match["start"], match["end"]
+        if start < 0:
+            problems.append(f"line {index + 1} starts before the audio ({start:.3f}s)")
+        if end < start:
+            problems.append(f"line {index + 1} ends before it starts ({start:.3f}s-{end:.3f}s)")
+        if start < previous_end:
+            problems.append(f"line {index + 1} starts at {start:.3f}s, before the previous line ends "
+                            f"({previous_end:.3f}s)")
+        if limit is not None and end > limit:
+            problems.append(f"line {index + 1} ends at {end:.3f}s, after the audio ({duration:.3f}s)")
+        previous_end = max(previous_end, end)
+    return problems
+
+class Alignment:
+    """The aligned lines of one song, in lyric order, for writing as a subtitle or lyrics file."""
+
+    __slots__ = ('lines',)
+
+    def __init__(self, lines: List[LyricLine]):
+        self.lines = lines
+
+    @classmethod
+    def from_dicts(cls, items: List[Dict]) -> 'Alignment':
+        return cls([LyricLine.from_dict(item) for item in items])
+
+    def to_lrc(self) -> str:
+        """LRC with one [mm:ss.xx] tag per line."""
+        rows = []
+        for line in self.lines:
+            centis = int(round(max(0.0, line.start) * 100))
+            minutes, centis = divmod(centis, 6000)
+            rows.append(f"[{minutes:02d}:{centis // 100:02d}.{centis % 100:02d}]{line.text}")
+        return '\n'.join(rows) + '\n'
+
+    def to_srt(self) -> str:
+        cues = [f"{index}\n{_clock(line.start, ',')} --> {_clock(line.end, ',')}\n{line.text}\n"
+                for index, line in enumerate(self.lines, 1)]
+        return '\n'.join(cues)
+
+    def to_vtt(self) -> str:
+        cues = [f"{_clock(line.start, '.')} --> {_clock(line.end, '.')}\n{line.text}\n" for line in self.lines]
+        return '\n'.join(['WEBVTT\n', *cues])
+
+    def serialize(self, fmt: str) -> str:
+        """The lines in one of FORMATS."""
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown lyrics format '{fmt}'. Must be one of: {', '.join(FORMATS)}")
+        return getattr(self, f'to_{fmt}')()
+
+FORMATS = ('json', 'lrc', 'srt', 'vtt')
@@ -1,56 +1,378 @@
+import time
+_imports_started = time.perf_counter()
+
 import argparse
 import os
 import sys
 import json
+import threading
+import base64
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-from utils import check_ffmpeg, clean_lyrics_text
+from utils import check_ffmpeg, clean_lyrics_text, hash_file, get_audio_duration
+from lyric_format import Alignment, timing_problems, FORMATS as LYRICS_FORMATS
+from scheduler import model_limiter
+import metrics
 from gemini_service import (
     match_lyrics_with_gemini,
+    stream_lyrics_with_gemini,
     generate_prompt_with_gemini,
     generate_image_with_gemini
 )
 
-def match_lyrics(audio_path: str, lyrics: List[str], model: str) -> Dict:
+IMPORT_SECONDS = time.perf_counter() - _imports_started
+
+# How generate_image returns the image bytes, see handle_generate_image
+IMAGE_OUTPUTS = ('base64', 'path', 'frame')
+
+def write_json(result: Dict, stream=None, **dumps_kwargs):
+    """Write a JSON document as one compact UTF-8 line to stdout (or the given stream)."""
+    stream = stream or sys.stdout
+    dumps_kwargs.setdefault('separators', (',', ':'))
+    with metrics.span('serialize'):
+        json_result = json.dumps(result, ensure_ascii=False, **dumps_kwargs)
+        encoded = json_result.encode('utf-8')
+    metrics.add_bytes('output', len(encoded) + 1)
+    if hasattr(stream, 'buffer'):
+        stream.buffer.write(encoded)
+        stream.buffer.write(b'\n')
+        stream.buffer.flush()
+    else:
+        print(json_result, file=stream)
+        stream.flush()
+
+def write_error(error: Exception):
+    """Write an error record to stderr."""
+    write_json({"error": str(error), "status": "error"}, stream=sys.stderr)
+
+def _check_timings(audio_path: str, matched_lyrics: List[Dict]) -> None:
+    """Report any timing that runs backwards or leaves the audio."""
+    problems = timing_problems(matched_lyrics, get_audio_duration(audio_path))
+    if problems:
+        metrics.increment('timing_problems', len(problems))
+        print(f"Alignment has {len(problems)} timing problems: {'; '.join(problems[:5])}", file=sys.stderr)
+
+def _lyrics_file(matched_lyrics: List[Dict], lyrics_format: str) -> Dict:
+    return {"format": lyrics_format, "content": Alignment.from_dicts(matched_lyrics).serialize(lyrics_format)}
+
+def match_lyrics(audio_path: str, lyrics: List[str], model: str, use_cache: bool = True,
+                 chunk_seconds: float = None, incremental: bool = True, lyrics_format: str = 'json') -> Dict:
     """Main function to process audio and match lyrics"""
-    try:
-        matched_lyrics = match_lyrics_with_gemini(audio_path, lyrics, model)
-        if not matched_lyrics:
-            raise ValueError("Failed to match lyrics")
-
-        result = {
-            "matched_lyrics": matched_lyrics,
-            "detected_language": "en",
-            "status": "success"
-        }
+    matched_lyrics = match_lyrics_with_gemini(audio_path, lyrics, model, use_cache=use_cache,
+                                              chunk_seconds=chunk_seconds, incremental=incremental)
+    if not matched_lyrics:
+        raise ValueError("Failed to match lyrics")
+
+    _check_timings(audio_path, matched_lyrics)
+    result = {
+        "matched_lyrics": matched_lyrics,
+        "detected_language": "en",
+        "status": "success"
+    }
+    if lyrics_format != 'json':
+        result["lyrics_file"] = _lyrics_file(matched_lyrics, lyrics_format)
+    return result
+
+def match_lyrics_stream(audio_path: str, lyrics: List[str], model: str, emit, use_cache: bool = True,
+                        incremental: bool = True, lyrics_format: str = 'json') -> Dict:
+    """Pass each aligned line to emit as soon as it is parsed and return a summary record."""
+    started = time.perf_counter()
+    first_line_seconds = None
+    lines = stream_lyrics_with_gemini(audio_path, lyrics, model, use_cache=use_cache, incremental=incremental)
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration as done:
+            # The whole-song result, as stored in the cache, rather than the lines refined one by one
+            matched_lyrics = done.value
+            break
+        if first_line_seconds is None:
+            first_line_seconds = round(time.perf_counter() - started, 3)
+        emit({"type": "line", **line})
+
+    if not matched_lyrics:
+        raise ValueError("Failed to match lyrics")
+
+    _check_timings(audio_path, matched_lyrics)
+    result = {
+        "type": "summary",
+        "matched_lyrics": matched_lyrics,
+        "detected_language": "en",
+        "line_count": len(matched_lyrics),
+        "first_line_seconds": first_line_seconds,
+        "total_seconds": round(time.perf_counter() - started, 3),
+        "status": "success"
+    }
+    if lyrics_format != 'json':
+        result["lyrics_file"] = _lyrics_file(matched_lyrics, lyrics_format)
+    return result
+
+def _parse_lyrics(lyrics):
+    """Accept lyrics either as a JSON string (CLI) or an already decoded value (serve mode)."""
+    if isinstance(lyrics, str):
+        return json.loads(lyrics)
+    return lyrics
+
+def handle_match(params: Dict, emit=None) -> Dict:
+    if not params.get('audio') or not params.get('lyrics'):
+        raise ValueError("Both audio and lyrics parameters are required for matching mode")
+
+    lyrics = _parse_lyrics(params['lyrics'])
+    audio_path = os.path.abspath(params['audio'])
+    model = params.get('model')
+
+    if not os.path.exists(audio_path):
+        raise FileNotFoundError(f"Audio file not found: {audio_path}")
+
+    if not model:
+        raise ValueError("Model parameter is required")
 
-        json_result = json.dumps(result, ensure_ascii=False, indent=2)
-        if hasattr(sys.stdout, 'buffer'):
-            sys.stdout.buffer.write(json_result.encode('utf-8'))
-            sys.stdout.buffer.write(b'\n')
-            sys.stdout.buffer.flush()
-        else:
-            print(json_result)
-            sys.stdout.flush()
+    lyrics_format = params.get('lyrics_format') or 'json'
+    if lyrics_format not in LYRICS_FORMATS:
+        raise ValueError(f"Invalid lyrics format: {lyrics_format}. Must be one of: {', '.join(LYRICS_FORMATS)}")
 
+    print(f"Using model: {model}", file=sys.stderr)
+
+    if params.get('stream'):
+        return match_lyrics_stream(audio_path, lyrics, model, emit or write_json,
+                                   use_cache=not params.get('no_cache'),
+                                   incremental=not params.get('no_incremental'), lyrics_format=lyrics_format)
+
+    chunk_seconds = params.get('chunk_seconds')
+    return match_lyrics(audio_path, lyrics, model, use_cache=not params.get('no_cache'),
+                        chunk_seconds=float(chunk_seconds) if chunk_seconds else None,
+                        incremental=not params.get('no_incremental'), lyrics_format=lyrics_format)
+
+def handle_generate_prompt(params: Dict, emit=None) -> Dict:
+    if not params.get('lyrics'):
+        raise ValueError("Lyrics parameter is required for prompt generation")
+
+    lyrics = _parse_lyrics(params['lyrics'])
+    model = params.get('model')
+    song_name = params.get('song') or "Unknown Song"
+
+    if not model:
+        raise ValueError("Model parameter is required for prompt generation")
+
+    print(f"Using model: {model}", file=sys.stderr)
+    try:
+        result = generate_prompt_with_gemini(lyrics, model, song_name, use_cache=not params.get('no_cache'))
+        # Ensure we have a valid result
+        if not result or not result.get("prompt"):
+            raise ValueError("No prompt was generated")
     except Exception as e:
-        error_result = {
-            "error": str(e),
-            "status": "error"
+        print(f"Error in generate_prompt: {str(e)}", file=sys.stderr)
+        raise
+
+    return result
+
+def handle_generate_image(params: Dict, emit=None) -> Dict:
+    """Generate an image and describe where to find it.
+
+    ``image_output`` picks how the image bytes are returned: ``base64`` inlines
+    them in the JSON result, ``path`` returns only a descriptor with the file's
+    ``path`` (copied to ``output`` when given), ``mime_type``, ``size`` and
+    ``sha256``, and ``frame`` (CLI only) writes the descriptor followed by
+    exactly ``size`` raw bytes on stdout.
+    """
+    if not params.get('prompt') or not params.get('album_art'):
+        raise ValueError("Both prompt and album_art parameters are required for image generation")
+
+    prompt = params['prompt']
+    album_art = params['album_art']
+    model = params.get('model')
+    image_output = params.get('image_output') or 'base64'
+    if image_output not in IMAGE_OUTPUTS:
+        raise ValueError(f"Invalid image output: {image_output}. Must be one of: {', '.join(IMAGE_OUTPUTS)}")
+
+    print(f"Using model: {model}", file=sys.stderr)
+    image_result = generate_image_with_gemini(prompt, album_art, model, use_cache=not params.get('no_cache'))
+    image_path = image_result["path"]
+
+    if image_output == 'base64':
+        with open(image_path, 'rb') as f:
+            image_data = base64.b64encode(f.read()).decode('utf-8')
+        # Don't print the full base64 image data to avoid cluttering the terminal
+        # Instead, print a placeholder and include the actual data in the JSON
+        print(f"Generated image data (length: {len(image_data)} bytes)", file=sys.stderr)
+
+        return {
+            "status": "success",
+            "data": image_data,
+            "mime_type": image_result["mime_type"]
         }
-        error_json = json.dumps(error_result, ensure_ascii=False)
-
-        if hasattr(sys.stderr, 'buffer'):
-            sys.stderr.buffer.write(error_json.encode('utf-8'))
-            sys.stderr.buffer.write(b'\n')
-            sys.stderr.buffer.flush()
-        else:
-            print(error_json, file=sys.stderr)
-        sys.exit(1)
+
+    if params.get('output'):
+        output_path = os.path.abspath(params['output'])
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        shutil.copyfile(image_path, output_path)
+        image_path = output_path
+
+    size = os.path.getsize(image_path)
+    print(f"Generated image at {image_path} ({size} bytes)", file=sys.stderr)
+    return {
+        "status": "success",
+        "path": image_path,
+        "mime_type": image_result["mime_type"],
+        "size": size,
+        "sha256": hash_file(image_path)
+    }
+
+def write_image_frame(descriptor: Dict, stream=None):
+    """Write an image descriptor line followed by the image's raw bytes."""
+    stream = stream or sys.stdout
+    write_json(descriptor, stream=stream)
+    out = stream.buffer if hasattr(stream, 'buffer') else stream
+    with open(descriptor["path"], 'rb') as f:
+        shutil.copyfileobj(f, out)
+    out.flush()
+
+# What each mode ends up importing, for the import time report
+MODE_IMPORTS = {
+    'startup': ['main'],
+    'match': ['main', 'google.genai'],
+    'match_chunked': ['main', 'google.genai', 'alignment'],
+    'generate_image': ['main', 'google.genai', 'album_art'],
+}
+
+def handle_import_report(params: Dict, emit=None) -> Dict:
+    """Measure the import cost of each mode in a fresh interpreter."""
+    report = {name: metrics.import_report(modules) for name, modules in MODE_IMPORTS.items()}
+    for name, entry in report.items():
+        print(f"{name}: {entry['total_ms']:.1f} ms over {entry['module_count']} modules", file=sys.stderr)
+    return {"status": "success", "import_times": report}
+
+MODE_HANDLERS = {
+    'match': handle_match,
+    'generate_prompt': handle_generate_prompt,
+    'generate_image': handle_generate_image,
+    'import_report': handle_import_report,
+}
+
+def serve(workers: int):
+    """Run as a long-lived worker speaking line-delimited JSON over stdin/stdout.
+
+    Each request line is an object with an ``id``, a ``mode`` and the same
+    parameters the CLI accepts (``audio``, ``lyrics``, ``model``, ...). Every
+    response line echoes the request ``id`` so callers can have several
+    requests in flight at once; streaming matches send ``"type": "line"``
+    records before their final response. A ``{"mode": "shutdown"}`` line, or closing
+    stdin, stops the worker once pending requests have finished.
+    """
+    protocol_out = sys.stdout
+    # Anything else printed to stdout by the services must not corrupt the protocol stream
+    sys.stdout = sys.stderr
+    write_lock = threading.Lock()
+
+    def respond(payload: Dict):
+        with write_lock:
+            write_json(payload, stream=protocol_out)
+
+    def run(request: Dict):
+        request_id = request.get('id')
+        with metrics.trace(str(request.get('mode')), id=request_id) as trace:
+            run_request(request, request_id, trace)
+
+    def run_request(request: Dict, request_id, trace):
+        try:
+            handler = MODE_HANDLERS.get(request.get('mode'))
+            if not handler:
+                raise ValueError(f"Unknown mode: {request.get('mode')}")
+            if request.get('image_output') == 'frame':
+                raise ValueError("Image frames are only available from the command line; use image_output 'path'")
+            result = handler(request, emit=lambda record: respond({"id": request_id, **record}))
+            respond({"id": request_id, **result})
+        except Exception as e:
+            trace.attrs['status'] = 'error'
+            print(f"Request {request_id} failed: {str(e)}", file=sys.stderr)
+            respond({"id": request_id, "error": str(e), "status": "error"})
+
+    stdin = sys.stdin.buffer if hasattr(sys.stdin, 'buffer') else sys.stdin
+    respond({"id": None, "status": "ready", "pid": os.getpid()})
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for raw_line in stdin:
+            line = raw_line.decode('utf-8') if isinstance(raw_line, bytes) else raw_line
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be a JSON object")
+            except ValueError as e:
+                respond({"id": None, "error": f"Invalid request: {str(e)}", "status": "error"})
+                continue
+
+            if request.get('mode') == 'shutdown':
+                break
+            pool.submit(run, request)
+
+def _read_manifest(manifest_path: str):
+    """Yield (line number, entry or parse error) for each non-empty manifest line."""
+    if manifest_path == '-':
+        stream = sys.stdin
+    else:
+        stream = open(manifest_path, 'r', encoding='utf-8')
+    try:
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                if not isinstance(entry, dict):
+                    raise ValueError("Manifest entry must be a JSON object")
+                yield line_number, entry
+            except ValueError as e:
+                yield line_number, e
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def batch_match(manifest_path: str, default_model: str, workers: int, model_concurrency: int, use_cache: bool = True,
+                chunk_seconds: float = None):
+    """Match every song listed in a JSONL manifest, streaming one result line per song.
+
+    Each manifest line holds ``audio``, ``lyrics`` and optionally ``model`` and
+    ``id``. Songs run concurrently on a bounded pool, with at most
+    model_concurrency generate_content calls per model. A failing song
+    produces an error line and does not stop the batch.
+    """
+    model_limiter.configure(model_concurrency)
+    write_lock = threading.Lock()
+    counts = {"success": 0, "error": 0}
+
+    def emit(record: Dict):
+        with write_lock:
+            counts[record["status"]] += 1
+            write_json(record)
+
+    def run(song_id, entry: Dict):
+        params = {"model": default_model, "chunk_seconds": chunk_seconds, **entry, "no_cache": not use_cache}
+        with metrics.trace('batch_match', id=song_id) as trace:
+            try:
+                result = handle_match(params)
+                emit({"id": song_id, "audio": entry.get("audio"), **result})
+            except Exception as e:
+                trace.attrs['status'] = 'error'
+                print(f"Batch entry {song_id} failed: {str(e)}", file=sys.stderr)
+                emit({"id": song_id, "audio": entry.get("audio"), "error": str(e), "status": "error"})
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for line_number, entry in _read_manifest(manifest_path):
+            if isinstance(entry, Exception):
+                emit({"id": line_number, "error": f"Invalid manifest entry: {str(entry)}", "status": "error"})
+                continue
+            pool.submit(run, entry.get("id", line_number), entry)
+
+    print(f"Batch finished: {counts['success']} succeeded, {counts['error']} failed", file=sys.stderr)
 
 def setup_argparse():
     """Set up command line argument parsing."""
     parser = argparse.ArgumentParser(description='Process audio files and match lyrics.')
-    parser.add_argument('--mode', required=True, choices=['match', 'generate_prompt', 'generate_image'], help='Operation mode')
+    parser.add_argument('--mode', required=True, choices=['match', 'batch_match', 'generate_prompt', 'generate_image', 'serve', 'import_report'], help='Operation mode')
     parser.add_argument('--audio', required=False, help='Path to the audio file')
     parser.add_argument('--lyrics', required=False, help='JSON string containing lyrics')
     parser.add_argument('--prompt', required=False, help='Generated prompt for image')
@@ -58,6 +380,25 @@ def setup_argparse():
     parser.add_argument('--model', required=False, help='Gemini model to use')
     parser.add_argument('--artist', required=False, help='Artist name')
     parser.add_argument('--song', required=False, help='Song name')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore cached results and store the fresh one')
+    parser.add_argument('--no-incremental', action='store_true',
+                        help='Align the whole song even if only a few lyric lines changed since the last match')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write each matched line as a JSON line as soon as it is parsed, then a summary')
+    parser.add_argument('--chunk-seconds', type=float, required=False,
+                        help='Align audio longer than this in parallel chunks of about this many seconds')
+    parser.add_argument('--lyrics-format', choices=LYRICS_FORMATS, default='json',
+                        help='Also return the matched lyrics as an LRC, SRT or WebVTT file in the result')
+    parser.add_argument('--image-output', choices=IMAGE_OUTPUTS, default='base64',
+                        help='Return generated images inline as base64, as a file path, or as a raw frame after the JSON line')
+    parser.add_argument('--output', required=False, help='Copy the generated image to this path')
+    parser.add_argument('--manifest', required=False, help="JSONL manifest for batch matching ('-' for stdin)")
+    parser.add_argument('--metrics', default='stderr',
+                        help="Where to write per-run metrics records: 'stderr', 'off' or a JSONL file to append to")
+    parser.add_argument('--metrics-prometheus', required=False,
+                        help='Also keep running totals in this file in Prometheus text format')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent requests handled in serve and batch modes')
+    parser.add_argument('--model-concurrency', type=int, default=2, help='Concurrent model calls per model in batch mode')
     return parser.parse_args()
 
 def main():
@@ -66,89 +407,33 @@ def main():
         import os, msvcrt
         msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
         msvcrt.setmode(sys.stderr.fileno(), os.O_BINARY)
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
 
     args = setup_argparse()
+    metrics.registry.configure(args.metrics, args.metrics_prometheus)
 
     try:
-        if args.mode == "match":
-            if not args.audio or not args.lyrics:
-                raise ValueError("Both audio and lyrics parameters are required for matching mode")
-
-            lyrics = json.loads(args.lyrics)
-            audio_path = os.path.abspath(args.audio)
-            model = args.model
-
-            if not os.path.exists(audio_path):
-                raise FileNotFoundError(f"Audio file not found: {audio_path}")
-
-            if not model:
-                raise ValueError("Model parameter is required")
+        if args.mode == "serve":
+            serve(max(1, args.workers))
+            return
 
-            print(f"Using model: {model}", file=sys.stderr)
+        if args.mode == "batch_match":
+            if not args.manifest:
+                raise ValueError("Manifest parameter is required for batch matching")
+            batch_match(args.manifest, args.model, max(1, args.workers), max(1, args.model_concurrency),
+                        use_cache=not args.no_cache, chunk_seconds=args.chunk_seconds)
+            return
 
-            match_lyrics(audio_path, lyrics, model)
-
-        elif args.mode == "generate_prompt":
-            if not args.lyrics:
-                raise ValueError("Lyrics parameter is required for prompt generation")
-
-            lyrics = json.loads(args.lyrics)
-            model = args.model
-            song_name = args.song or "Unknown Song"
-
-            if not model:
-                raise ValueError("Model parameter is required for prompt generation")
-
-            print(f"Using model: {model}", file=sys.stderr)
-            try:
-                result = generate_prompt_with_gemini(lyrics, model, song_name)
-                # Ensure we have a valid result
-                if not result or not result.get("prompt"):
-                    raise ValueError("No prompt was generated")
-            except Exception as e:
-                print(f"Error in generate_prompt: {str(e)}", file=sys.stderr)
-                raise
-
-        elif args.mode == "generate_image":
-            if not args.prompt or not args.album_art:
-                raise ValueError("Both prompt and album_art parameters are required for image generation")
-
-            prompt = args.prompt
-            album_art = args.album_art
-            model = args.model
-
-            print(f"Using model: {model}", file=sys.stderr)
-            image_result = generate_image_with_gemini(prompt, album_art, model)
-            # Don't print the full base64 image data to avoid cluttering the terminal
-            # Instead, print a placeholder and include the actual data in the JSON
-            data_length = len(image_result["data"]) if "data" in image_result else 0
-            print(f"Generated image data (length: {data_length} bytes)", file=sys.stderr)
-
-            result = {
-                "status": "success",
-                "data": image_result["data"],
-                "mime_type": image_result["mime_type"]
-            }
-            # Use sys.stdout.buffer to write binary data without printing to console
-            if hasattr(sys.stdout, 'buffer'):
-                sys.stdout.buffer.write(json.dumps(result).encode('utf-8'))
-                sys.stdout.buffer.write(b'\n')
-                sys.stdout.buffer.flush()
+        with metrics.trace(args.mode, model=args.model) as trace:
+            trace.add_span('imports', IMPORT_SECONDS)
+            result = MODE_HANDLERS[args.mode](vars(args))
+            if args.mode == "generate_image" and args.image_output == "frame":
+                write_image_frame(result)
             else:
-                print(json.dumps(result))
+                write_json(result)
 
     except Exception as e:
-        error_result = {
-            "error": str(e),
-            "status": "error"
-        }
-
-        error_json = json.dumps(error_result, ensure_ascii=False)
-        if hasattr(sys.stderr, 'buffer'):
-            sys.stderr.buffer.write(error_json.encode('utf-8'))
-            sys.stderr.buffer.write(b'\n')
-        else:
-            print(error_json, file=sys.stderr)
+        write_error(e)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,268 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+def _windows_peak_rss() -> Optional[int]:
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return int(counters.PeakWorkingSetSize)
+    except Exception:
+        return None
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident memory of this process in bytes, or None where it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        return _windows_peak_rss()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class Trace:
+    """Span timings and byte counts collected for one run or request."""
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans: Dict[str, Dict] = {}
+        self.bytes: Dict[str, int] = {}
+        self.counters: Dict[str, int] = {}
+
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            entry = self.spans.setdefault(name, {"seconds": 0.0, "count": 0})
+            entry["seconds"] += seconds
+            entry["count"] += 1
+
+    def add_bytes(self, name: str, count: int):
+        with self._lock:
+            self.bytes[name] = self.bytes.get(name, 0) + int(count)
+
+    def increment(self, name: str, count: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def record(self) -> Dict:
+        with self._lock:
+            return {
+                "type": "metrics",
+                "name": self.name,
+                **self.attrs,
+                "pid": os.getpid(),
+                "started_at": round(self.started_at, 3),
+                "total_seconds": round(time.perf_counter() - self._started, 6),
+                "spans": {name: {"seconds": round(entry["seconds"], 6), "count": entry["count"]}
+                          for name, entry in self.spans.items()},
+                "bytes": dict(self.bytes),
+                "counters": dict(self.counters),
+                "peak_rss_bytes": peak_rss_bytes(),
+            }
+
+class MetricsRegistry:
+    """Process-wide totals across traces, exported in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.output = 'stderr'
+        self.prometheus_path = None
+        self._runs: Dict[tuple, int] = {}
+        self._spans: Dict[str, Dict] = {}
+        self._bytes: Dict[str, int] = {}
+        self._counters: Dict[str, int] = {}
+        self._states: Dict[str, Callable[[], List[Dict]]] = {}
+
+    def register_state(self, name: str, snapshot: Callable[[], List[Dict]]):
+        """Add a component's current state to every record and to the Prometheus export.
+
+        snapshot returns one row per tracked item; string fields become labels
+        and numeric fields gauges named after the component.
+        """
+        with self._lock:
+            self._states[name] = snapshot
+
+    def states(self) -> Dict[str, List[Dict]]:
+        with self._lock:
+            snapshots = dict(self._states)
+        return {name: rows for name, rows in ((name, snapshot()) for name, snapshot in snapshots.items()) if rows}
+
+    def configure(self, output: str = 'stderr', prometheus_path: str = None):
+        """Send records to stderr, append them as JSON lines to a file, or turn them off ('off')."""
+        self.output = output or 'stderr'
+        self.prometheus_path = prometheus_path
+
+    def observe(self, record: Dict):
+        with self._lock:
+            run_key = (record["name"], record.get("status", "success"))
+            self._runs[run_key] = self._runs.get(run_key, 0) + 1
+            for name, entry in record["spans"].items():
+                total = self._spans.setdefault(name, {"seconds": 0.0, "count": 0})
+                total["seconds"] += entry["seconds"]
+                total["count"] += entry["count"]
+            for name, count in record["bytes"].items():
+                self._bytes[name] = self._bytes.get(name, 0) + count
+            for name, count in record["counters"].items():
+                self._counters[name] = self._counters.get(name, 0) + count
+
+    def emit(self, record: Dict):
+        self.observe(record)
+        record = {**record, **self.states()}
+        if self.output == 'stderr':
+            print(json.dumps(record, ensure_ascii=False), file=sys.stderr)
+        elif self.output != 'off':
+            try:
+                with self._lock, open(self.output, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            except OSError as e:
+                print(f"Error writing metrics: {str(e)}", file=sys.stderr)
+        if self.prometheus_path:
+            self.write_prometheus(self.prometheus_path)
+
+    def prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            lines.append('# TYPE lyrics_syncer_runs_total counter')
+            for (name, status), count in sorted(self._runs.items()):
+                lines.append(f'lyrics_syncer_runs_total{{mode="{name}",status="{status}"}} {count}')
+            lines.append('# TYPE lyrics_syncer_span_seconds summary')
+            for name, entry in sorted(self._spans.items()):
+                lines.append(f'lyrics_syncer_span_seconds_sum{{span="{name}"}} {entry["seconds"]:.6f}')
+                lines.append(f'lyrics_syncer_span_seconds_count{{span="{name}"}} {entry["count"]}')
+            lines.append('# TYPE lyrics_syncer_bytes_total counter')
+            for name, count in sorted(self._bytes.items()):
+                lines.append(f'lyrics_syncer_bytes_total{{kind="{name}"}} {count}')
+            lines.append('# TYPE lyrics_syncer_events_total counter')
+            for name, count in sorted(self._counters.items()):
+                lines.append(f'lyrics_syncer_events_total{{event="{name}"}} {count}')
+        for name, rows in self.states().items():
+            gauges: Dict[str, List[str]] = {}
+            for row in rows:
+                labels = ','.join(f'{key}="{value}"' for key, value in row.items() if isinstance(value, str))
+                for key, value in row.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        gauges.setdefault(f'lyrics_syncer_{name}_{key}', []).append(f'{{{labels}}} {value}')
+            for metric, samples in gauges.items():
+                lines.append(f'# TYPE {metric} gauge')
+                lines.extend(f'{metric}{sample}' for sample in samples)
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines.append('# TYPE lyrics_syncer_peak_rss_bytes gauge')
+            lines.append(f'lyrics_syncer_peak_rss_bytes {peak}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """Write the totals for a node_exporter textfile collector or similar scraper."""
+        try:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing Prometheus metrics: {str(e)}", file=sys.stderr)
+
+registry = MetricsRegistry()
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+@contextmanager
+def trace(name: str, **attrs):
+    """Collect spans for one run or request and emit its metrics record when it ends."""
+    current = Trace(name, **attrs)
+    token = _current_trace.set(current)
+    status = 'success'
+    try:
+        yield current
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        _current_trace.reset(token)
+        current.attrs.setdefault('status', status)
+        registry.emit(current.record())
+
+@contextmanager
+def span(name: str):
+    """Time a stage of the current trace; a no-op outside of one."""
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add_span(name, time.perf_counter() - started)
+
+def add_bytes(name: str, count: int):
+    current = _current_trace.get()
+    if current is not None:
+        current.add_bytes(name, count)
+
+def increment(name: str, count: int = 1):
+    current = _current_trace.get()
+    if current is not None:
+        current.increment(name, count)
+
+def import_report(modules, limit: int = 15) -> Dict:
+    """Import the given modules in a fresh interpreter under ``-X importtime`` and summarize the cost.
+
+    Returns the total import time and the most expensive modules by
+    cumulative time, counting only the outermost import of each package.
+    """
+    import subprocess
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', '; '.join(f'import {module}' for module in modules)],
+        cwd=backend_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {', '.join(modules)} failed: {result.stderr.decode('utf-8', 'replace')[-500:]}")
+
+    entries = []
+    for line in result.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append({"module": name.strip(), "depth": depth,
+                        "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+
+    top_level = [entry for entry in entries if entry["depth"] == 0]
+    # One level down shows which dependency a top-level module spends its time on
+    slowest = sorted((entry for entry in entries if entry["depth"] <= 1),
+                     key=lambda entry: entry["cumulative_ms"], reverse=True)[:limit]
+    return {
+        "modules": list(modules),
+        "total_ms": round(sum(entry["cumulative_ms"] for entry in top_level), 3),
+        "module_count": len(entries),
+        "slowest": [{key: entry[key] for key in ("module", "cumulative_ms", "self_ms")} for entry in slowest],
+    }
@@ -0,0 +1,322 @@
+import re
+import sys
+import time
+import random
+import hashlib
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+import metrics
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether an API error is a rate limit or transient server failure worth retrying."""
+    code = getattr(error, 'code', None)
+    if code in RETRYABLE_STATUS_CODES:
+        return True
+    message = str(error)
+    return 'RESOURCE_EXHAUSTED' in message or 'UNAVAILABLE' in message
+
+def requested_delay(error: Exception) -> float:
+    """The retry delay a rate-limit error asks for, or 0 when it names none."""
+    requested = re.search(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s", str(error))
+    return float(requested.group(1)) if requested else 0.0
+
+def retry_delay(error: Exception, attempt: int, base_delay: float, max_delay: float) -> float:
+    """Exponential backoff with full jitter, never shorter than a retry delay the API asked for."""
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    return max(delay, min(max_delay, requested_delay(error)))
+
+class ModelLimiter:
+    """Caps how many calls run against each model at the same time.
+
+    Without a configured limit calls are not restricted, which keeps the
+    single-request modes unchanged.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limit = None
+        self._overrides: Dict[str, int] = {}
+        self._semaphores: Dict[str, threading.Semaphore] = {}
+
+    def configure(self, default_limit: int = None, overrides: Dict[str, int] = None):
+        with self._lock:
+            self._limit = default_limit
+            self._overrides = dict(overrides or {})
+            self._semaphores = {}
+
+    def _semaphore(self, model_name: str):
+        with self._lock:
+            limit = self._overrides.get(model_name, self._limit)
+            if not limit:
+                return None
+            if model_name not in self._semaphores:
+                self._semaphores[model_name] = threading.BoundedSemaphore(limit)
+            return self._semaphores[model_name]
+
+    @contextmanager
+    def slot(self, model_name: str):
+        semaphore = self._semaphore(model_name)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+model_limiter = ModelLimiter()
+
+class RequestCoalescer:
+    """Runs identical concurrent calls once and hands every caller the same outcome."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Dict] = {}
+
+    def run(self, key: str, fn: Callable):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._in_flight[key] = call
+
+        if not leader:
+            print(f"Joining in-flight request {key[:12]}", file=sys.stderr)
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call["done"].set()
+
+coalescer = RequestCoalescer()
+
+DISPATCHER_DEFAULTS = {
+    # Rolling one-minute budgets per key and model; null means unlimited
+    "requestsPerMinute": None,
+    "tokensPerMinute": None,
+    # Per-model overrides, e.g. {"gemini-2.5-pro": {"requestsPerMinute": 5}}
+    "modelLimits": {},
+    # Faster model to use while a model's smoothed latency is over latencySloSeconds
+    "fallbackModels": {},
+    "latencySloSeconds": None,
+    # How long a fallback lasts before the slower model is tried again
+    "sloRecoverySeconds": 300,
+    # How long a rate-limited key is left alone for that model while other keys take its calls
+    "cooldownSeconds": 30,
+    "retries": 4,
+}
+
+BUDGET_WINDOW = 60.0
+LATENCY_SMOOTHING = 0.3
+
+class Lease:
+    """The key, client and model one attempt of a dispatched call runs with."""
+
+    def __init__(self, dispatcher: 'Dispatcher', api_key: str, key_id: str, model: str, client):
+        self._dispatcher = dispatcher
+        self.api_key = api_key
+        self.key_id = key_id
+        self.model = model
+        self.client = client
+
+    def record_usage(self, response):
+        """Count the tokens a response reports against this key's budget."""
+        usage = getattr(response, 'usage_metadata', None)
+        tokens = getattr(usage, 'total_token_count', None) if usage is not None else None
+        if tokens:
+            self._dispatcher.add_tokens(self.key_id, self.model, int(tokens))
+
+class Dispatcher:
+    """Spreads model calls over a pool of API keys within per-key, per-model budgets.
+
+    Each call runs on the key with the most room left in its rolling
+    one-minute request and token budgets. A key that is rate limited cools
+    down for that model while the call fails over to another key; only when
+    no key is left does the call back off with jitter. A model whose
+    smoothed latency exceeds the SLO is swapped for its configured fallback
+    until sloRecoverySeconds have passed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: Dict[str, str] = {}
+        self._settings = dict(DISPATCHER_DEFAULTS)
+        self._requests: Dict[tuple, deque] = {}
+        self._tokens: Dict[tuple, deque] = {}
+        self._cooldowns: Dict[tuple, float] = {}
+        self._stats: Dict[tuple, Dict[str, int]] = {}
+        self._latency: Dict[str, float] = {}
+        self._fallback_since: Dict[str, float] = {}
+
+    @staticmethod
+    def key_id(api_key: str) -> str:
+        """Short, non-reversible id for an API key, safe to log and export."""
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+
+    def configure(self, api_keys: List[str], settings: Dict = None):
+        """Set the key pool and budgets; usage already counted for a key is kept."""
+        with self._lock:
+            self._keys = {self.key_id(api_key): api_key for api_key in api_keys}
+            self._settings = {**DISPATCHER_DEFAULTS, **(settings or {})}
+
+    def _limits(self, model: str):
+        limits = {**self._settings, **self._settings["modelLimits"].get(model, {})}
+        return limits["requestsPerMinute"], limits["tokensPerMinute"]
+
+    def _window(self, events: Dict[tuple, deque], slot: tuple, now: float) -> deque:
+        window = events.setdefault(slot, deque())
+        while window and window[0][0] <= now - BUDGET_WINDOW:
+            window.popleft()
+        return window
+
+    def _wait_for(self, key_id: str, model: str, now: float) -> float:
+        """Seconds until the key can take another call for the model, 0 if it can now."""
+        slot = (key_id, model)
+        wait = max(0.0, self._cooldowns.get(slot, 0.0) - now)
+        requests_limit, tokens_limit = self._limits(model)
+        requests = self._window(self._requests, slot, now)
+        if requests_limit and len(requests) >= requests_limit:
+            wait = max(wait, requests[len(requests) - requests_limit][0] + BUDGET_WINDOW - now)
+        tokens = self._window(self._tokens, slot, now)
+        if tokens_limit and sum(count for _, count in tokens) >= tokens_limit:
+            wait = max(wait, tokens[0][0] + BUDGET_WINDOW - now)
+        return wait
+
+    def _route(self, model: str, now: float) -> str:
+        fallback = self._settings["fallbackModels"].get(model)
+        slo = self._settings["latencySloSeconds"]
+        if not fallback or not slo or self._latency.get(model, 0.0) <= slo:
+            return model
+        since = self._fallback_since.setdefault(model, now)
+        if now - since < self._settings["sloRecoverySeconds"]:
+            return fallback
+        # Give the slower model another chance to show its latency has recovered
+        del self._fallback_since[model]
+        self._latency.pop(model, None)
+        return model
+
+    def _acquire(self, model: str):
+        """Reserve a request on the key with the most headroom; returns (key_id, model, wait)."""
+        with self._lock:
+            if not self._keys:
+                raise ValueError("Gemini API key not found in config")
+            now = time.monotonic()
+            routed = self._route(model, now)
+            waits = {key_id: self._wait_for(key_id, routed, now) for key_id in self._keys}
+            ready = [key_id for key_id, wait in waits.items() if wait == 0]
+            if not ready:
+                return None, routed, min(waits.values())
+            key_id = min(ready, key=lambda key_id: len(self._requests[(key_id, routed)]))
+            self._requests[(key_id, routed)].append((now, 1))
+            self._stat(key_id, routed, 'requests')
+            return key_id, routed, 0.0
+
+    def _stat(self, key_id: str, model: str, name: str, count: int = 1):
+        stats = self._stats.setdefault((key_id, model), {"requests": 0, "tokens": 0, "errors": 0, "rate_limited": 0})
+        stats[name] += count
+
+    def add_tokens(self, key_id: str, model: str, tokens: int):
+        with self._lock:
+            self._tokens.setdefault((key_id, model), deque()).append((time.monotonic(), tokens))
+            self._stat(key_id, model, 'tokens', tokens)
+
+    def _succeeded(self, model: str, seconds: float):
+        with self._lock:
+            previous = self._latency.get(model)
+            self._latency[model] = seconds if previous is None else (
+                LATENCY_SMOOTHING * seconds + (1 - LATENCY_SMOOTHING) * previous)
+
+    def _failed(self, key_id: str, model: str, error: Exception, backoff: float) -> bool:
+        """Record a failed attempt; returns whether another key can take the retry right away.
+
+        A rate-limited key is left alone for cooldownSeconds when the call can
+        fail over to another key. Without one, the retry backs off on the same
+        key, which is then only held back for that backoff.
+        """
+        with self._lock:
+            self._stat(key_id, model, 'errors')
+            now = time.monotonic()
+            other_key_ready = any(self._wait_for(other, model, now) == 0 for other in self._keys if other != key_id)
+            if getattr(error, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(error):
+                self._stat(key_id, model, 'rate_limited')
+                cooldown = max(self._settings["cooldownSeconds"], requested_delay(error)) if other_key_ready else backoff
+                self._cooldowns[(key_id, model)] = now + cooldown
+            return other_key_ready
+
+    def run(self, model: str, attempt: Callable[[Lease], object], client_factory: Callable[[str], object],
+            label: str = 'request', base_delay: float = 2.0, max_delay: float = 60.0):
+        """Call attempt(lease) on a key with budget left, failing over and backing off on retryable errors.
+
+        client_factory maps an API key to its client. attempt runs again from
+        the start on each retry, so everything tied to a key, like uploaded
+        files, has to be set up inside it.
+        """
+        failures = 0
+        while True:
+            key_id, routed, wait = self._acquire(model)
+            if key_id is None:
+                wait = min(wait, max_delay)
+                print(f"{label}: every API key is rate limited or over budget for {routed}, "
+                      f"waiting {wait:.1f}s", file=sys.stderr)
+                metrics.increment('dispatch_budget_wait')
+                time.sleep(wait)
+                continue
+            if routed != model:
+                metrics.increment('dispatch_fallback')
+
+            lease = Lease(self, self._keys[key_id], key_id, routed, client_factory(self._keys[key_id]))
+            started = time.perf_counter()
+            try:
+                result = attempt(lease)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                delay = retry_delay(e, failures, base_delay, max_delay)
+                other_key_ready = self._failed(key_id, routed, e, delay)
+                if failures >= self._settings["retries"]:
+                    raise
+                failures += 1
+                if other_key_ready:
+                    print(f"{label} failed on key {key_id} ({str(e)[:200]}), failing over", file=sys.stderr)
+                    metrics.increment('dispatch_failover')
+                    continue
+                print(f"{label} failed ({str(e)[:200]}), retrying in {delay:.1f}s", file=sys.stderr)
+                metrics.increment('dispatch_backoff')
+                time.sleep(delay)
+                continue
+            self._succeeded(routed, time.perf_counter() - started)
+            return result
+
+    def snapshot(self) -> List[Dict]:
+        """Usage, budget and cooldown state per key and model, for the metrics output."""
+        with self._lock:
+            now = time.monotonic()
+            rows = []
+            for (key_id, model), stats in sorted(self._stats.items()):
+                rows.append({
+                    "key": key_id,
+                    "model": model,
+                    **stats,
+                    "window_requests": len(self._window(self._requests, (key_id, model), now)),
+                    "window_tokens": sum(count for _, count in self._window(self._tokens, (key_id, model), now)),
+                    "cooldown_seconds": round(max(0.0, self._cooldowns.get((key_id, model), 0.0) - now), 3),
+                    "latency_seconds": round(self._latency.get(model, 0.0), 3),
+                    "fallback_active": int(model in self._fallback_since),
+                })
+            return rows
+
+dispatcher = Dispatcher()
+metrics.registry.register_state('dispatcher', dispatcher.snapshot)
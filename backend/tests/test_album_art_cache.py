@@ -0,0 +1,27 @@
+import os
+from PIL import Image
+import album_art
+
+def write_art(directory, name, color):
+    path = os.path.join(directory, f"{name}.png")
+    Image.new('RGB', (64, 64), color).save(path)
+    return path
+
+def test_least_recently_used_art_is_evicted(tmp_path, monkeypatch):
+    art_dir = tmp_path / 'album_art'
+    monkeypatch.setattr(album_art, 'ART_DIR', str(art_dir))
+    first = album_art.album_art_path(write_art(tmp_path, 'first', 'red'))
+    second = album_art.album_art_path(write_art(tmp_path, 'second', 'green'))
+    os.utime(first, (1000, 1000))
+    os.utime(second, (2000, 2000))
+    # Room for two copies, but not three
+    monkeypatch.setattr(album_art, 'ART_MAX_BYTES', int(os.path.getsize(first) * 2.5))
+    # A hit makes the first copy the most recently used one
+    assert album_art.album_art_path(os.path.join(tmp_path, 'first.png')) == first
+
+    third = album_art.album_art_path(write_art(tmp_path, 'third', 'blue'))
+
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
+    assert sorted(os.listdir(art_dir)) == sorted(os.path.basename(path)[:-4] + ext
+                                                 for path in (first, third) for ext in ('.json', '.png'))
@@ -0,0 +1,99 @@
+import pytest
+import scheduler
+from scheduler import Dispatcher
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class RateLimited(Exception):
+    code = 429
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler, 'time', clock)
+    return clock
+
+def flaky(failures_by_key):
+    """An attempt that is rate limited the given number of times per key, then answers with the key."""
+    calls = []
+
+    def attempt(lease):
+        calls.append(lease.api_key)
+        if failures_by_key.get(lease.api_key, 0) > 0:
+            failures_by_key[lease.api_key] -= 1
+            raise RateLimited('429 RESOURCE_EXHAUSTED')
+        return lease.api_key
+
+    return attempt, calls
+
+def test_single_key_backs_off_once_with_jitter(clock):
+    dispatcher = Dispatcher()
+    dispatcher.configure(['only'], {"cooldownSeconds": 30})
+    attempt, calls = flaky({'only': 1})
+
+    assert dispatcher.run('model', attempt, lambda api_key: None, base_delay=2.0) == 'only'
+    assert calls == ['only', 'only']
+    assert len(clock.sleeps) == 1 and clock.sleeps[0] <= 2.0
+
+def test_rate_limited_key_fails_over_without_waiting(clock):
+    dispatcher = Dispatcher()
+    dispatcher.configure(['first', 'second'], {"cooldownSeconds": 30})
+    attempt, calls = flaky({'first': 1, 'second': 0})
+
+    assert dispatcher.run('model', attempt, lambda api_key: None) == 'second'
+    assert clock.sleeps == []
+    # The rate-limited key sits out its cooldown while the other one takes the calls
+    assert [dispatcher.run('model', attempt, lambda api_key: None) for _ in range(3)] == ['second'] * 3
+    rows = {row["key"]: row for row in dispatcher.snapshot()}
+    assert rows[Dispatcher.key_id('first')]["cooldown_seconds"] == 30
+
+def test_request_budget_spreads_calls_over_keys(clock):
+    dispatcher = Dispatcher()
+    dispatcher.configure(['first', 'second'], {"requestsPerMinute": 1})
+    attempt, _ = flaky({})
+
+    assert sorted(dispatcher.run('model', attempt, lambda api_key: None) for _ in range(2)) == ['first', 'second']
+    assert dispatcher.run('model', attempt, lambda api_key: None) in ('first', 'second')
+    assert clock.sleeps and clock.sleeps[0] == pytest.approx(60.0)
+
+class FakeUploadCache:
+    def get(self, key):
+        return None
+
+    def put(self, key, entry):
+        pass
+
+def test_rate_limited_upload_fails_over_to_another_key(clock, monkeypatch):
+    import gemini_service
+    monkeypatch.setattr(gemini_service, 'upload_cache', FakeUploadCache())
+    uploads = []
+
+    def client_for(api_key):
+        def upload(file):
+            uploads.append(api_key)
+            if api_key == 'first':
+                raise RateLimited('429 RESOURCE_EXHAUSTED')
+            return type('File', (), {"name": "files/1", "uri": "uri", "mime_type": "audio/mpeg",
+                                     "expiration_time": None})()
+        return type('Client', (), {"files": type('Files', (), {"upload": staticmethod(upload)})()})()
+
+    dispatcher = Dispatcher()
+    dispatcher.configure(['first', 'second'], {"cooldownSeconds": 30})
+    result = dispatcher.run('model', lambda lease: gemini_service.upload_audio(lease.client, 'song.mp3', 'key'),
+                            client_for)
+
+    assert result[0].name == 'files/1'
+    assert uploads == ['first', 'second']
+    assert clock.sleeps == []
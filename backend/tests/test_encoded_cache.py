@@ -0,0 +1,69 @@
+import os
+import subprocess
+import utils
+
+def write_entry(directory, name, size, mtime):
+    path = os.path.join(directory, f"{name}.mp3")
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    with open(os.path.join(directory, f"{name}.json"), 'w', encoding='utf-8') as f:
+        f.write('{"offset": 0.0}')
+    os.utime(path, (mtime, mtime))
+    return path
+
+def test_least_recently_used_encodings_are_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'ENCODED_DIR', str(tmp_path))
+    monkeypatch.setattr(utils, 'ENCODED_MAX_BYTES', 250)
+    oldest = write_entry(tmp_path, 'oldest', 100, 1000)
+    recent = write_entry(tmp_path, 'recent', 100, 3000)
+    newest = write_entry(tmp_path, 'newest', 100, 2000)
+
+    utils._evict_encoded(keep=newest)
+
+    assert sorted(os.listdir(tmp_path)) == ['newest.json', 'newest.mp3', 'recent.json', 'recent.mp3']
+    assert not os.path.exists(oldest)
+    assert os.path.exists(recent)
+
+class FakeFfmpeg:
+    """Stands in for subprocess.run, writing the output file and exiting with the given code."""
+
+    def __init__(self, returncode=0):
+        self.returncode = returncode
+        self.calls = 0
+
+    def __call__(self, args, **kwargs):
+        self.calls += 1
+        with open(args[-1], 'wb') as f:
+            f.write(b'encoded')
+        return subprocess.CompletedProcess(args, self.returncode, b'', b'encoder failed')
+
+def use_fake_ffmpeg(tmp_path, monkeypatch, returncode=0):
+    encoded_dir = tmp_path / 'encoded'
+    monkeypatch.setattr(utils, 'ENCODED_DIR', str(encoded_dir))
+    monkeypatch.setattr(utils.shutil, 'which', lambda name: '/usr/bin/' + name)
+    ffmpeg = FakeFfmpeg(returncode)
+    monkeypatch.setattr(utils.subprocess, 'run', ffmpeg)
+    source = tmp_path / 'song.wav'
+    source.write_bytes(b'original audio')
+    return str(source), encoded_dir, ffmpeg
+
+def test_unreadable_sidecar_is_a_miss(tmp_path, monkeypatch):
+    source, encoded_dir, ffmpeg = use_fake_ffmpeg(tmp_path, monkeypatch)
+    first = utils.preprocess_audio(source, {"trimSilence": False})
+    # A reader can land between the encoded file appearing and its sidecar being filled in
+    with open(os.path.splitext(first["path"])[0] + '.json', 'w', encoding='utf-8'):
+        pass
+
+    second = utils.preprocess_audio(source, {"trimSilence": False})
+
+    assert second["cached"] is False and second["path"] == first["path"]
+    assert ffmpeg.calls == 2
+    assert utils.preprocess_audio(source, {"trimSilence": False})["cached"] is True
+
+def test_failed_encode_leaves_no_partial_file(tmp_path, monkeypatch):
+    source, encoded_dir, ffmpeg = use_fake_ffmpeg(tmp_path, monkeypatch, returncode=1)
+
+    result = utils.preprocess_audio(source, {"trimSilence": False})
+
+    assert result["path"] == source and ffmpeg.calls == 1
+    assert os.listdir(encoded_dir) == []
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+import alignment
+import gemini_service
+
+DURATION = 60.0
+
+def previous_alignment(lines):
+    return {"lyrics": lines, "matches": [{"start": index * 3.0, "end": index * 3.0 + 2.5, "text": line, "language": "en"}
+                                         for index, line in enumerate(lines)]}
+
+@pytest.fixture
+def aligned_windows(monkeypatch):
+    """Stub out audio and the model; records the lyric lines each window was aligned with."""
+    windows = []
+
+    def fake_align(audio_path, template, lines, model_name):
+        windows.append(list(lines))
+        return [{"start": index * 0.5, "end": index * 0.5 + 0.4, "text": line, "language": "en"}
+                for index, line in enumerate(lines)]
+
+    monkeypatch.setattr(gemini_service, '_align_audio', fake_align)
+    monkeypatch.setattr(gemini_service, '_refine_matches', lambda audio_path, matches, duration: matches)
+    monkeypatch.setattr(alignment, 'load_pcm', lambda audio_path: np.zeros(16000, dtype=np.float32))
+    monkeypatch.setattr(alignment, 'write_wav_chunk', lambda *args: None)
+    return windows
+
+def realign(old, new):
+    previous = previous_alignment(list(old))
+    result = gemini_service._match_incremental('song.wav', 'hash', list(new), 'model', previous, DURATION,
+                                               max_changed_fraction=1.0)
+    return previous, result
+
+def assert_consistent(previous, new, result):
+    assert [match["text"] for match in result] == list(new)
+    for earlier, later in zip(result, result[1:]):
+        assert earlier["end"] <= later["start"]
+    old_timings = {match["text"]: (match["start"], match["end"]) for match in previous["matches"]}
+    for match in result:
+        if match["text"] in old_timings:
+            assert (match["start"], match["end"]) == old_timings[match["text"]]
+
+def test_edit_next_to_trailing_insert(aligned_windows):
+    previous, result = realign('ABCDEFGHXI', 'ABCDEFGHYIJK')
+    assert_consistent(previous, 'ABCDEFGHYIJK', result)
+    assert aligned_windows == [list('GHYI'), list('IJK')]
+
+def test_leading_insert(aligned_windows):
+    previous, result = realign('ABCDEFGH', 'XYABCDEFGH')
+    assert_consistent(previous, 'XYABCDEFGH', result)
+    assert aligned_windows == [list('XYAB')]
+
+def test_edits_separated_by_one_unchanged_line(aligned_windows):
+    previous, result = realign('ABCDEFGHIJ', 'ABCXEYGHIJ')
+    assert_consistent(previous, 'ABCXEYGHIJ', result)
+    assert sorted(aligned_windows) == [list('BCXE'), list('EYGH')]
+
+def test_failed_incremental_match_falls_back_to_full_alignment(monkeypatch):
+    lyrics = ['first line', 'second line']
+    full = [{"start": 0.0, "end": 1.0, "text": "first line", "language": "en"},
+            {"start": 1.0, "end": 2.0, "text": "second line", "language": "en"}]
+
+    class FakeResultCache:
+        def get(self, key):
+            return None
+
+        def get_latest(self, audio_hash):
+            return previous_alignment(['first line', 'old line'])
+
+        def put(self, key, matches):
+            pass
+
+        def put_latest(self, audio_hash, lines, matches):
+            pass
+
+    def broken_incremental(*args, **kwargs):
+        raise IndexError("list index out of range")
+
+    monkeypatch.setattr(gemini_service, 'result_cache', FakeResultCache())
+    monkeypatch.setattr(gemini_service, '_match_cache_key', lambda *args: 'key')
+    monkeypatch.setattr(gemini_service, 'get_audio_duration', lambda audio_path: DURATION)
+    monkeypatch.setattr(gemini_service, 'hash_file', lambda audio_path: 'hash')
+    monkeypatch.setattr(gemini_service, '_match_incremental', broken_incremental)
+    monkeypatch.setattr(gemini_service, '_align_audio', lambda *args: [dict(match) for match in full])
+    monkeypatch.setattr(gemini_service, '_refine_matches', lambda audio_path, matches, duration: matches)
+
+    assert gemini_service.match_lyrics_with_gemini('song.wav', lyrics, 'model') == full
@@ -0,0 +1,32 @@
+import pytest
+from utils import normalize_lyrics, normalize_lyrics_bulk
+
+@pytest.mark.parametrize('line', [
+    '(Break my heart) tonight',
+    '(Drop it low)',
+    'I said (hook me up)',
+    '(Intro to the night) we go',
+    '[I love you] she said',
+])
+def test_bracketed_lyrics_are_kept(line):
+    assert normalize_lyrics([line]) == ([line], [0])
+
+@pytest.mark.parametrize('marker', [
+    '[Verse 1]', '[Chorus]', '[Chorus: Artist & Other]', '[Pre-Chorus 2]', '[Hook x2]',
+    '(Chorus)', '(Verse 2)', '(Outro: Artist)', '( Bridge )', 'Chorus:', 'Verse 2:',
+    '[Instrumental Break]', '[Guitar Solo]', '[Post Chorus]', '[Final Chorus]', '[Chorus 2x]',
+    '[Chorus (x2)]', '[Verse 2 - Artist]', '[Intro/Verse 1]', '[Spoken Word]', '[Produced by X]',
+    '[Bridge over the water]', '  [Guitar Solo]  ',
+])
+def test_section_markers_are_removed(marker):
+    assert normalize_lyrics([marker, 'sung line']) == (['sung line'], [1])
+
+def test_inline_marker_keeps_the_lyric():
+    assert normalize_lyrics(['[Chorus] la la', 'na na (Chorus)']) == (['la la', 'na na'], [0, 1])
+
+def test_characters_and_spaces_are_normalized():
+    assert normalize_lyrics(['“Hello” —  it’s me…', '​']) == (['"Hello" - it\'s me...'], [0])
+
+def test_bulk_keeps_songs_apart():
+    assert normalize_lyrics_bulk([['[Intro]', 'one'], [], ['two', 'Chorus:']]) == [
+        (['one'], [1]), ([], []), (['two'], [0])]
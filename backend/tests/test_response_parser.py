@@ -0,0 +1,98 @@
+import json
+import time
+import pytest
+from utils import LyricResponseParser, parse_gemini_response
+from benchmark import MALFORMED_VARIANTS
+
+def lyric_objects(count: int):
+    return [{"start": round(index * 2.5, 2), "end": round(index * 2.5 + 2.0, 2), "text": f"line {index} of the song",
+             "language": "en"} for index in range(count)]
+
+def well_formed(count: int) -> str:
+    return "```json\n" + json.dumps(lyric_objects(count), indent=2) + "\n```"
+
+def feed_in_chunks(text: str, size: int):
+    parser = LyricResponseParser()
+    items = []
+    for start in range(0, len(text), size):
+        items.extend(parser.feed(text[start:start + size]))
+    items.extend(parser.close())
+    return items, parser.repairs
+
+RESPONSES = {"well_formed": well_formed(12)}
+RESPONSES.update({name: variant(RESPONSES["well_formed"]) for name, variant in MALFORMED_VARIANTS.items()})
+RESPONSES.update({
+    "smart_quotes": '[{“start”: 1.0, “end”: 2.0, “text”: “hi”, “language”: “en”}]',
+    "unquoted_keys": '[{start: 1.0, end: 2.0, text: "hi", language: "en"}]',
+    "nested_value": '[{"start": 1, "end": 2, "text": "x", "meta": {"a": "}"}}, {"start": 3, "end": 4, "text": "y"}]',
+    "brace_in_text": '[{"start": 1, "end": 2, "text": "a } b { c"}, {"start": 2, "end": 3, "text": "d"}]',
+})
+
+@pytest.mark.parametrize('size', [1, 3, 17, 256])
+@pytest.mark.parametrize('name', sorted(RESPONSES))
+def test_chunked_feed_matches_whole_feed(name, size):
+    whole = feed_in_chunks(RESPONSES[name], len(RESPONSES[name]))
+    assert feed_in_chunks(RESPONSES[name], size) == whole
+    assert whole[0]
+
+@pytest.mark.parametrize('name', sorted(MALFORMED_VARIANTS))
+def test_malformed_variants_recover_lines(name):
+    items, repairs = parse_gemini_response(RESPONSES[name])
+    expected = lyric_objects(12)
+    if name == 'truncated':
+        # The cut-off last object is either recovered without its tail or dropped
+        assert items[:len(items) - 1] == expected[:len(items) - 1] and len(items) >= 10
+    elif name == 'unescaped_quotes':
+        assert [item["text"] for item in items[:3]] == [f'say "hey" {line["text"]}' for line in expected[:3]]
+        assert items[3:] == expected[3:]
+    else:
+        assert items == expected
+    if name != 'prose_around':
+        assert repairs
+
+@pytest.mark.parametrize('text, expected, repair', [
+    ('[{“start”: 1.0, “end”: 2.0, “text”: “hi”}]', [(1.0, 2.0, 'hi')], 'smart_quote'),
+    ("[{'start': 1.0, 'end': 2.0, 'text': 'it\\'s'}]", [(1.0, 2.0, "it's")], 'single_quote'),
+    ('[{start: 1.0, end: 2.0, text: "hi"}]', [(1.0, 2.0, 'hi')], 'unquoted_key'),
+    ('[{"start": 1 "end": 2 "text": "a"}]', [(1.0, 2.0, 'a')], 'missing_comma'),
+    ('[{"start": 1, "end": 2, "text": "a",},]', [(1.0, 2.0, 'a')], 'trailing_comma'),
+    ('[{"start": "0:01.5", "end": 1:03.25, "text": "a"}]', [(1.5, 63.25, 'a')], 'time_format'),
+    ('[{"start": 1, "end": 2, "text": "a"}, {"start": 2, "end": 3, "text": "b"', [(1.0, 2.0, 'a'), (2.0, 3.0, 'b')],
+     'unterminated_object'),
+    ('[{"start": 1, "end": 2, "text": "say "hi" now"}]', [(1.0, 2.0, 'say "hi" now')], 'unescaped_quote'),
+    ('Sure! [{"start": 1, "end": 2, "text": "a"}] Done.', [(1.0, 2.0, 'a')], 'skipped_text'),
+])
+def test_repairs(text, expected, repair):
+    for size in (1, len(text)):
+        items, repairs = feed_in_chunks(text, size)
+        assert [(item["start"], item["end"], item["text"]) for item in items] == expected
+        assert repairs[repair]
+
+def test_braces_in_text_and_nested_values_are_kept():
+    items, _ = parse_gemini_response(RESPONSES["brace_in_text"])
+    assert [item["text"] for item in items] == ["a } b { c", "d"]
+    items, _ = feed_in_chunks(RESPONSES["nested_value"], 1)
+    assert [(item["text"], item.get("meta")) for item in items] == [("x", {"a": "}"}), ("y", None)]
+
+def test_wrapper_object_is_scanned_inside():
+    items, _ = feed_in_chunks('{"lyrics": [{"start": 1, "end": 2, "text": "a"}]}', 4)
+    assert [item["text"] for item in items] == ["a"]
+
+def test_results_are_sorted_with_float_times():
+    items, _ = parse_gemini_response('[{"start": "3", "end": 4, "text": "b"}, {"start": 1, "end": 2, "text": "a"}]')
+    assert [(item["start"], item["text"]) for item in items] == [(1.0, "a"), (3.0, "b")]
+    assert all(isinstance(item["start"], float) and isinstance(item["end"], float) for item in items)
+
+@pytest.mark.parametrize('lines', [10, 100, 1000])
+@pytest.mark.parametrize('name', ['well_formed', 'missing_commas', 'single_quoted_keys', 'truncated'])
+def test_parse_time_scales_linearly(name, lines):
+    text = well_formed(lines)
+    if name != 'well_formed':
+        text = MALFORMED_VARIANTS[name](text)
+    started = time.perf_counter()
+    for _ in range(3):
+        items, _ = parse_gemini_response(text)
+    per_line = (time.perf_counter() - started) / 3 / lines
+    assert len(items) >= (lines * 0.85 if name == 'truncated' else lines)
+    # Generous bound: the tolerant scanner takes a few microseconds per line, quadratic behaviour far more
+    assert per_line < 0.0005
@@ -0,0 +1,16 @@
+from types import SimpleNamespace
+import cache as cache_module
+from cache import ResultCache
+
+def test_latest_alignments_keep_only_the_most_recent_files(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module, 'time', SimpleNamespace(time=lambda: now[0]))
+    cache = ResultCache(path=str(tmp_path / 'results.sqlite3'), max_latest=2)
+    matches = [{"start": 0.0, "end": 1.0, "text": "line", "language": "en"}]
+    for audio_hash in ('first', 'second', 'third'):
+        now[0] += 1
+        cache.put_latest(audio_hash, ['line'], matches)
+
+    assert cache.get_latest('first') is None
+    assert cache.get_latest('second') == {"lyrics": ['line'], "matches": matches}
+    assert cache.get_latest('third') == {"lyrics": ['line'], "matches": matches}
@@ -0,0 +1,69 @@
+import gemini_service
+import main
+
+DURATION = 30.0
+
+class FakeResultCache:
+    def __init__(self, latest=None):
+        self.stored = {}
+        self.latest = latest
+
+    def get(self, key):
+        return self.stored.get(key)
+
+    def put(self, key, matches):
+        self.stored[key] = matches
+
+    def get_latest(self, audio_hash):
+        return self.latest
+
+    def put_latest(self, audio_hash, lines, matches):
+        self.latest = {"lyrics": lines, "matches": matches}
+
+def stub_audio(monkeypatch, cache):
+    monkeypatch.setattr(gemini_service, 'load_config', lambda: {"alignmentRefinement": {"enabled": False}})
+    monkeypatch.setattr(gemini_service, 'result_cache', cache)
+    monkeypatch.setattr(gemini_service, '_match_cache_key', lambda *args, **kwargs: 'key')
+    monkeypatch.setattr(gemini_service, 'get_audio_duration', lambda audio_path: DURATION)
+    monkeypatch.setattr(main, 'get_audio_duration', lambda audio_path: DURATION)
+    monkeypatch.setattr(gemini_service, 'hash_file', lambda audio_path: 'hash')
+
+def test_streamed_lines_stay_ordered_and_summary_matches_cache(monkeypatch):
+    streamed = [
+        {"start": 0.5, "end": 4.0, "text": "one", "language": "en"},
+        {"start": 3.0, "end": 6.0, "text": "two", "language": "en"},
+        {"start": 6.5, "end": 9.0, "text": "three", "language": "en"},
+    ]
+    cache = FakeResultCache()
+    stub_audio(monkeypatch, cache)
+    monkeypatch.setattr(gemini_service, '_stream_alignment', lambda *args: iter([dict(line) for line in streamed]))
+
+    emitted = []
+    summary = main.match_lyrics_stream('song.wav', ['one', 'two', 'three'], 'model', emitted.append)
+
+    lines = [record for record in emitted if record["type"] == "line"]
+    for earlier, later in zip(lines, lines[1:]):
+        assert earlier["end"] <= later["start"]
+    assert summary["matched_lyrics"] == cache.stored['key']
+
+    replayed = main.match_lyrics_stream('song.wav', ['one', 'two', 'three'], 'model', lambda record: None)
+    assert replayed["matched_lyrics"] == summary["matched_lyrics"]
+
+def test_edited_lyrics_stream_an_incremental_realignment(monkeypatch):
+    previous = {"lyrics": ['one', 'two'], "matches": [{"start": 0.0, "end": 2.0, "text": "one", "language": "en"},
+                                                    {"start": 3.0, "end": 5.0, "text": "two", "language": "en"}]}
+    realigned = [{"start": 0.0, "end": 2.0, "text": "one", "language": "en"},
+                 {"start": 3.0, "end": 5.0, "text": "too", "language": "en"}]
+    cache = FakeResultCache(latest=previous)
+    stub_audio(monkeypatch, cache)
+    monkeypatch.setattr(gemini_service, '_match_incremental', lambda *args: [dict(line) for line in realigned])
+
+    def whole_song(*args):
+        raise AssertionError("the whole song was realigned")
+    monkeypatch.setattr(gemini_service, '_stream_alignment', whole_song)
+
+    emitted = []
+    summary = main.match_lyrics_stream('song.wav', ['one', 'too'], 'model', emitted.append)
+
+    assert [record["text"] for record in emitted] == ['one', 'too']
+    assert summary["matched_lyrics"] == realigned == cache.stored['key']
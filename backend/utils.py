@@ -4,8 +4,19 @@ import re
 import json
 import sys
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from collections import Counter
 import subprocess
+import threading
+import hashlib
+import time
+import queue
+import gzip
+import atexit
+import itertools
+from functools import lru_cache
+import metrics
+from cache import write_json_atomic, read_json
 
 def check_ffmpeg():
     """Check if ffmpeg is available in the system."""
@@ -16,13 +27,81 @@ def check_ffmpeg():
         )
     return ffmpeg_path
 
+# Separators used to run a whole batch of lyrics through the engine as one string
+_LINE_SEPARATOR = '\x1e'
+_SONG_SEPARATOR = '\x1d'
+
+_SECTION_NAMES = (r'(?:intro|outro|verse|pre-?chorus|post-?chorus|chorus|refrain|bridge|hook|interlude'
+                  r'|instrumental|breakdown|break|drop|skit|spoken|coda|ending)')
+# A section name, an optional number and repeat count, and an optional ": Artist" credit
+_MARKER_BODY = rf'\s*{_SECTION_NAMES}(?:\s*\d+)?(?:\s*[x\u00d7]\s*\d+)?\s*(?::{{close}}*)?'
+# Every section marker variant in one pattern: lines made up of one bracketed group such as
+# [Guitar Solo] or [Verse 2 - Artist], inline [Verse 1], [Chorus: Artist], (Chorus) and (Verse 2 x2),
+# and lines that only hold a heading such as "Chorus:" or "Verse 2:". Inline brackets and parentheses
+# holding anything else, like "(Drop it low)", are sung lyrics and stay.
+_SECTION_MARKER = re.compile(
+    r'(?<![^\x1d\x1e]) *\[[^\]\x1d\x1e]*\] *(?=[\x1d\x1e]|\Z)'
+    r'|\[' + _MARKER_BODY.format(close=r'[^\]\x1d\x1e]') + r'\]'
+    r'|\(' + _MARKER_BODY.format(close=r'[^)\x1d\x1e]') + r'\)'
+    rf'|(?<![^\x1d\x1e]) *{_SECTION_NAMES}(?: *\d+)? *: *(?=[\x1d\x1e]|\Z)',
+    re.IGNORECASE
+)
+_SPACE_RUNS = re.compile(r' {2,}')
+
+# Smart punctuation to ASCII, odd whitespace to plain spaces, invisible characters removed
+_CHARACTER_REPLACEMENTS = {
+    **dict.fromkeys('\u2018\u2019\u201a\u201b\u2032\u00b4\u0060', "'"),
+    **dict.fromkeys('\u201c\u201d\u201e\u201f\u2033\u00ab\u00bb', '"'),
+    **dict.fromkeys('\u2010\u2011\u2012\u2013\u2014\u2015\u2212', '-'),
+    '\u2026': '...',
+    **dict.fromkeys('\t\n\r\v\f\u00a0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007'
+                    '\u2008\u2009\u200a\u202f\u205f\u3000', ' '),
+    **dict.fromkeys('\u200b\u200c\u200d\u2060\ufeff\u00ad', ''),
+}
+# These characters are rare, so a regex scan beats str.translate with a table this size
+_SPECIAL_CHARACTERS = re.compile('[' + re.escape(''.join(_CHARACTER_REPLACEMENTS)) + ']')
+
+def _replace_character(match) -> str:
+    return _CHARACTER_REPLACEMENTS[match.group()]
+
+def normalize_lyrics_bulk(songs: List[List[str]]) -> List[Tuple[List[str], List[int]]]:
+    """Normalize the lyric lines of many songs at once.
+
+    Section markers, smart punctuation and extra whitespace are handled for
+    the whole batch in a few regex passes over a single joined string,
+    instead of per line. For each song, returns the non-empty cleaned lines
+    and, for each of them, the index of the input line it came from.
+    """
+    if not songs:
+        return []
+    text = _SONG_SEPARATOR.join(_LINE_SEPARATOR.join(map(str, lines)) for lines in songs)
+    separators = sum(max(len(lines) - 1, 0) for lines in songs) + len(songs) - 1
+    if text.count(_LINE_SEPARATOR) + text.count(_SONG_SEPARATOR) != separators:
+        # Separators inside the input would read as line breaks; they are control characters, never lyrics
+        drop = str.maketrans('', '', _LINE_SEPARATOR + _SONG_SEPARATOR)
+        text = _SONG_SEPARATOR.join(_LINE_SEPARATOR.join(str(line).translate(drop) for line in lines)
+                                    for lines in songs)
+
+    text = _SPECIAL_CHARACTERS.sub(_replace_character, text)
+    text = _SPACE_RUNS.sub(' ', _SECTION_MARKER.sub('', text))
+
+    results = []
+    for song in text.split(_SONG_SEPARATOR):
+        stripped = [line.strip() for line in song.split(_LINE_SEPARATOR)]
+        index_map = [index for index, line in enumerate(stripped) if line]
+        results.append(([stripped[index] for index in index_map], index_map))
+    return results
+
+def normalize_lyrics(lines: List[str]) -> Tuple[List[str], List[int]]:
+    """Clean lyric lines for alignment, returning the non-empty lines and their original indices."""
+    if not lines:
+        return [], []
+    return normalize_lyrics_bulk([lines])[0]
+
 def clean_lyrics_text(text: str) -> str:
     """Remove song structure markers and clean lyrics text."""
-    markers = [r'\[Verse \d+\]', r'\[Chorus\]', r'\[Refrain\]', r'\[Bridge\]', r'\[Outro\]', r'\[Intro\]']
-    cleaned = text
-    for marker in markers:
-        cleaned = re.sub(marker, '', cleaned, flags=re.IGNORECASE)
-    return cleaned.strip()
+    cleaned, _ = normalize_lyrics(text.splitlines())
+    return '\n'.join(cleaned)
 
 def convert_time_to_seconds(time_str: str) -> float:
     """Convert time string to seconds."""
@@ -32,147 +111,857 @@ def convert_time_to_seconds(time_str: str) -> float:
         minutes, seconds = time_str.split(':')
         return float(minutes) * 60 + float(seconds)
 
-def clean_gemini_response(response_text: str, debug_file: str = None) -> str:
-    """Clean Gemini response text to extract valid JSON"""
-    cleaned = ''
+_WHITESPACE = re.compile(r'\s*')
+_BARE_WORD = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_NUMBER = re.compile(r'-?\d+(?::\d+)*(?:\.\d+)?(?:[eE][+-]?\d+)?')
+_QUOTED_KEY_AHEAD = re.compile(r'["“”\']\w+["“”\']\s*:')
+_DOUBLE_QUOTES = '"“”'
+_STRING_STOPS = {
+    '"': re.compile(r'["“”\\]'),
+    "'": re.compile(r"['\\]"),
+}
+_JSON_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '/': '/', '\\': '\\', '"': '"', "'": "'"}
+_LITERALS = {'true': True, 'false': False, 'null': None, 'True': True, 'False': False, 'None': None}
+_NESTED_STOPS = re.compile(r'[{}\[\]"\\]')
+_INCOMPLETE = object()
 
-    try:
-        cleaned = re.sub(r'```(?:json)?\s*|\s*```', '', response_text)
-        cleaned = cleaned.strip()
-
-        char_replacements = {
-            '"': '"',
-            '"': '"',
-            ''': "'",
-            ''': "'",
-            '–': '-',
-            '—': '-',
-            '': '',
-            '': ''
-        }
-
-        for old, new in char_replacements.items():
-            if old in cleaned:
-                cleaned = cleaned.replace(old, new)
-
-        cleaned = re.sub(r'}\s*,?\s*,?\s*{', '}, {', cleaned)
-        cleaned = re.sub(r',\s*,', ',', cleaned)
-
-        def fix_text(match):
-            text = match.group(1)
-            if '\\"' in text:
-                text = text.replace('\\\\"', '\\"').replace('""', '"')
+class LyricResponseParser:
+    """Tolerant, incremental parser for the list of lyric objects Gemini returns.
+
+    Text can be fed in pieces; every ``{start, end, text, language}`` object is
+    returned as soon as it is complete. Anything outside objects (code fences,
+    prose, brackets) is skipped, and common defects are repaired on the way:
+    single or curly quotes, unquoted keys, unescaped quotes inside text,
+    missing or doubled commas, ``mm:ss`` and string timestamps, and a final
+    object cut off before its closing brace. ``repairs`` counts what was fixed.
+    """
+
+    _COMPACT_AFTER = 64 * 1024
+
+    def __init__(self):
+        self._buffer = ''
+        self._pos = 0
+        self.repairs = Counter()
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """Add text and return the objects completed by it."""
+        self._buffer += chunk
+        return self._drain(final=False)
+
+    def close(self) -> List[Dict]:
+        """Finish parsing and return any objects left in the buffer."""
+        items = self._drain(final=True)
+        self._buffer, self._pos = '', 0
+        return items
+
+    def _drain(self, final: bool) -> List[Dict]:
+        items = []
+        buffer = self._buffer
+        while True:
+            start = buffer.find('{', self._pos)
+            if start < 0 and not final:
+                # Text between objects is judged once it is complete, so it counts the same however it was split
+                break
+            skipped = buffer[self._pos:start if start >= 0 else len(buffer)]
+            if skipped.strip(' \t\r\n[],'):
+                self.repairs['skipped_text'] += 1
+            if start < 0:
+                self._pos = len(buffer)
+                break
+
+            # Intact objects decode at C speed; only damaged ones go through the tolerant scanner.
+            # Decode a slice: errors on the whole buffer would count lines from its start every time.
+            status = None
+            close = buffer.find('}', start)
+            if close >= 0:
+                try:
+                    obj = json.loads(buffer[start:close + 1])
+                    if 'start' in obj:
+                        status, end = 'ok', close + 1
+                except ValueError:
+                    pass
+            if status is None:
+                repairs = self.repairs.copy()
+                status, obj, end = self._parse_object(buffer, start, final)
+                if status == 'abandon' and not final and buffer.find('}', end) < 0:
+                    # The object may only look broken because the rest has not arrived yet
+                    status = 'incomplete'
+                if status == 'incomplete' and not final:
+                    # It is parsed again once more text arrives; count its repairs only then
+                    self.repairs = repairs
+            if status == 'incomplete':
+                if not final:
+                    self._pos = start
+                    break
+                item = self._validate(obj)
+                if item:
+                    self.repairs['unterminated_object'] += 1
+                    items.append(item)
+                self._pos = len(buffer)
+                break
+            if status == 'ok':
+                item = self._validate(obj)
+                if item:
+                    items.append(item)
+                else:
+                    self.repairs['dropped_object'] += 1
+            self._pos = end
+
+        if self._pos > self._COMPACT_AFTER:
+            self._buffer = buffer[self._pos:]
+            self._pos = 0
+        return items
+
+    def _validate(self, obj: Dict):
+        if not obj or 'start' not in obj or 'end' not in obj or 'text' not in obj:
+            return None
+        # Objects are freshly decoded, so they are completed in place rather than copied
+        item = obj
+        for key in ('start', 'end'):
+            value = item[key]
+            if isinstance(value, str):
+                try:
+                    value = convert_time_to_seconds(value.strip())
+                except ValueError:
+                    return None
+                self.repairs['string_time'] += 1
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return None
+            item[key] = float(value)
+        item['text'] = '' if item['text'] is None else str(item['text'])
+        item.setdefault('language', '')
+        return item
+
+    def _parse_object(self, s: str, i: int, final: bool):
+        """Parse the object starting at s[i] == '{'.
+
+        Returns (status, fields, end): 'ok' with the index after '}',
+        'incomplete' when the text ends first, or 'abandon' with the index to
+        resume scanning from when the object is not a lyric object, such as a
+        wrapper around the list. Nested values of a lyric object are kept.
+        """
+        obj = {}
+        j = i + 1
+        n = len(s)
+        while True:
+            j = _WHITESPACE.match(s, j).end()
+            if j >= n:
+                return 'incomplete', obj, j
+            c = s[j]
+            if c == '}':
+                return 'ok', obj, j + 1
+            if c == ',':
+                self.repairs['extra_comma'] += 1
+                j += 1
+                continue
+
+            if c in _DOUBLE_QUOTES or c == "'":
+                key, j = self._parse_string(s, j, final, is_key=True)
+                if key is _INCOMPLETE:
+                    return 'incomplete', obj, j
             else:
-                text = text.replace('\\\\', '\\').replace('\\\"', '\"').replace('""', '"')
-            return f'"text": "{text}"'
+                word = _BARE_WORD.match(s, j)
+                if not word:
+                    # Nested containers or stray characters: resume scanning inside them
+                    return 'abandon', obj, j if c in '{[' else j + 1
+                key, j = word.group(0), word.end()
+                self.repairs['unquoted_key'] += 1
 
-        cleaned = re.sub(r'"text":\s*"([^"]*)"', fix_text, cleaned)
+            j = _WHITESPACE.match(s, j).end()
+            if j >= n:
+                return 'incomplete', obj, j
+            if s[j] in ':=':
+                j = _WHITESPACE.match(s, j + 1).end()
+            else:
+                self.repairs['missing_colon'] += 1
+            if j >= n:
+                return 'incomplete', obj, j
 
-        lines = []
-        for line in cleaned.split('\n'):
-            line = line.strip()
-            if line:
-                line = re.sub(r'\s*:\s*', ': ', line)
-                line = re.sub(r'\s*,\s*', ', ', line)
-                lines.append(line)
+            value, j = self._parse_value(s, j, final)
+            if value is _INCOMPLETE:
+                return 'incomplete', obj, j
+            if value is None and j < n and s[j] in '{[':
+                if 'start' not in obj:
+                    return 'abandon', obj, j
+                value, j = self._parse_nested(s, j)
+                if value is _INCOMPLETE:
+                    return 'incomplete', obj, j
+            obj[key] = value
 
-        cleaned = '\n'.join(lines)
+            j = _WHITESPACE.match(s, j).end()
+            if j >= n:
+                return 'incomplete', obj, j
+            c = s[j]
+            if c == ',':
+                j = _WHITESPACE.match(s, j + 1).end()
+                if j < n and s[j] == '}':
+                    self.repairs['trailing_comma'] += 1
+            elif c != '}':
+                if c in _DOUBLE_QUOTES or c == "'" or _BARE_WORD.match(s, j):
+                    self.repairs['missing_comma'] += 1
+                else:
+                    return 'abandon', obj, j
 
+    def _parse_nested(self, s: str, j: int):
+        """Skip the object or list starting at s[j], decoding it if it is valid JSON."""
+        depth = 0
+        in_string = False
+        k = j
+        while True:
+            stop = _NESTED_STOPS.search(s, k)
+            if not stop:
+                return _INCOMPLETE, j
+            c, k = stop.group(), stop.end()
+            if in_string:
+                if c == '\\':
+                    k += 1
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c in '{[':
+                depth += 1
+            elif c in '}]':
+                depth -= 1
+                if depth == 0:
+                    break
         try:
-            data = json.loads(cleaned)
-        except json.JSONDecodeError as e:
-            print(f"Initial JSON parsing failed: {str(e)}", file=sys.stderr)
+            return json.loads(s[j:k]), k
+        except ValueError:
+            self.repairs['dropped_value'] += 1
+            return None, k
 
-            if debug_file:
-                print(f"Attempting to repair malformed JSON from: {debug_file}", file=sys.stderr)
+    def _parse_value(self, s: str, j: int, final: bool):
+        c = s[j]
+        if c in _DOUBLE_QUOTES or c == "'":
+            return self._parse_string(s, j, final)
+        number = _NUMBER.match(s, j)
+        if number:
+            end = number.end()
+            if end >= len(s) and not final:
+                return _INCOMPLETE, j
+            text = number.group(0)
+            if ':' in text:
+                self.repairs['time_format'] += 1
+                return convert_time_to_seconds(text), end
+            return (float(text) if any(ch in text for ch in '.eE') else int(text)), end
+        word = _BARE_WORD.match(s, j)
+        if word and word.group(0) in _LITERALS:
+            if word.end() >= len(s) and not final:
+                return _INCOMPLETE, j
+            return _LITERALS[word.group(0)], word.end()
+        # Not a scalar: let the caller decide (nested value or garbage)
+        return None, j
 
-            time_pattern = r'(?:\d+\.\d+|\d+|\d+:\d+\.\d+)'
-            pattern = (
-                r'\{\s*"start"\s*:\s*(' + time_pattern + r')\s*,\s*"end"\s*:\s*(' + time_pattern + r')\s*,\s*' +
-                r'"text"\s*:\s*"([^"]*)"\s*,\s*"language"\s*:\s*"([^"]*)"\s*\}' 
-            )
-            matches = re.findall(pattern, cleaned)
+    def _closes_string(self, s: str, k: int, is_key: bool):
+        """Decide whether the quote at s[k] ends the string, by what follows it."""
+        n = _WHITESPACE.match(s, k + 1).end()
+        if n >= len(s):
+            return None
+        follower = s[n]
+        if is_key:
+            return follower in ':='
+        if follower in ',}]':
+            return True
+        # A following "key": means the comma between two fields is missing
+        return bool(_QUOTED_KEY_AHEAD.match(s, n))
 
-            if not matches:
-                raise ValueError("Could not extract valid JSON objects from response")
+    def _parse_string(self, s: str, i: int, final: bool, is_key: bool = False):
+        opening = s[i]
+        smart = opening in '“”'
+        if opening == "'":
+            stops = _STRING_STOPS["'"]
+            self.repairs['single_quote'] += 1
+        else:
+            stops = _STRING_STOPS['"']
+            if smart:
+                self.repairs['smart_quote'] += 1
 
-            data = []
-            for start, end, text, language in matches:
-                data.append({
-                    "start": start,
-                    "end": end,
-                    "text": text,
-                    "language": language
-                })
+        parts = []
+        j = i + 1
+        while True:
+            match = stops.search(s, j)
+            if not match:
+                return _INCOMPLETE, i
+            k = match.start()
+            parts.append(s[j:k])
+            c = s[k]
+            if c == '\\':
+                if k + 1 >= len(s):
+                    return _INCOMPLETE, i
+                escaped = s[k + 1]
+                if escaped == 'u':
+                    if k + 6 > len(s):
+                        return _INCOMPLETE, i
+                    try:
+                        parts.append(chr(int(s[k + 2:k + 6], 16)))
+                        j = k + 6
+                        continue
+                    except ValueError:
+                        pass
+                parts.append(_JSON_ESCAPES.get(escaped, escaped))
+                j = k + 2
+                continue
 
-            print(f"Extracted {len(data)} valid entries from malformed JSON", file=sys.stderr)
+            closes = self._closes_string(s, k, is_key)
+            if closes is None:
+                if not final:
+                    return _INCOMPLETE, i
+                closes = True
+            if closes:
+                if c != '"' and opening != "'" and not smart:
+                    self.repairs['smart_quote'] += 1
+                return ''.join(parts), k + 1
+            # A quote inside the text that was not escaped
+            if opening != "'":
+                self.repairs['unescaped_quote'] += 1
+            parts.append(c)
+            j = k + 1
 
-        if not isinstance(data, list):
-            raise ValueError("Root element must be an array")
+def parse_gemini_response(response_text: str) -> Tuple[List[Dict], Counter]:
+    """Recover lyric objects from a Gemini response in one pass, sorted by start time.
 
-        data.sort(key=lambda x: float(x["start"]))
+    Returns the objects and a counter of the repairs that were needed.
+    """
+    stripped = response_text.strip()
+    if stripped.startswith('```'):
+        # Well-formed JSON inside a code fence is by far the common case; C-speed json handles it
+        stripped = stripped[stripped.find('\n') + 1:] if '\n' in stripped else ''
+        if stripped.rstrip().endswith('```'):
+            stripped = stripped.rstrip()[:-3]
+    try:
+        data = json.loads(stripped)
+    except ValueError:
+        data = None
 
-        normalized = []
-        for item in data:
-            if not isinstance(item, dict):
-                continue
-            normalized.append(item)
+    parser = LyricResponseParser()
+    if isinstance(data, list) and all(isinstance(item, dict) for item in data):
+        items = [parser._validate(item) for item in data]
+        if all(items):
+            items.sort(key=lambda item: item['start'])
+            return items, parser.repairs
 
-        return json.dumps(normalized, indent=2)
+    items = parser.feed(response_text)
+    items.extend(parser.close())
+    items.sort(key=lambda item: item['start'])
+    return items, parser.repairs
 
-    except Exception as e:
-        print(f"Error cleaning response: {str(e)}", file=sys.stderr)
+def clean_gemini_response(response_text: str, debug_file: str = None) -> List[Dict]:
+    """Extract the lyric objects from Gemini response text, sorted by start time."""
+    with metrics.span('parse_response'):
+        items, repairs = parse_gemini_response(response_text)
+    if repairs:
+        source = f" (raw response in {debug_file})" if debug_file else ''
+        print(f"Repaired Gemini response{source}: {dict(repairs)}", file=sys.stderr)
+    if not items:
+        raise ValueError("Invalid JSON in response: could not extract valid lyric objects")
+    print(f"Extracted {len(items)} lyric entries", file=sys.stderr)
+    return items
+
+DEBUG_DIR = os.path.join(os.path.dirname(__file__), 'debug')
+
+class DebugSink:
+    """Writes debug artifacts on a background thread.
+
+    Callers only enqueue content, so nothing is written on the request path.
+    Pending files are flushed at interpreter exit. Files can be gzip
+    compressed, and old ones are removed by age and by the total size of the
+    debug directory.
+    """
+
+    RETENTION_INTERVAL = 60
+
+    def __init__(self, debug_dir: str = DEBUG_DIR):
+        self.debug_dir = debug_dir
+        self.enabled = True
+        self.compress = False
+        self.max_age_days = 7
+        self.max_total_mb = 200
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._thread = None
+        self._last_retention = 0.0
+
+    def configure(self, enabled: bool = True, compress: bool = False, maxAgeDays: float = 7,
+                  maxTotalMB: float = 200, **_):
+        """Apply the ``debug`` section of config.json."""
+        self.enabled = enabled
+        self.compress = compress
+        self.max_age_days = maxAgeDays
+        self.max_total_mb = maxTotalMB
+
+    def new_id(self) -> str:
+        """An id that stays unique across threads and processes writing at the same moment."""
+        return f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}_{next(self._counter)}"
+
+    def write(self, filename: str, content: str):
+        """Queue a file for writing and return the path it will have, or None when disabled."""
+        if not self.enabled:
+            return None
+        if self.compress:
+            filename += '.gz'
+        self._ensure_thread()
+        self._queue.put((filename, content))
+        return os.path.join(self.debug_dir, filename)
+
+    def flush(self, timeout: float = 10.0):
+        """Wait until everything queued so far is on disk."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='debug-sink', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
 
-        if debug_file and os.path.exists(debug_file):
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    continue
+                self._write_file(*item)
+            if time.time() - self._last_retention > self.RETENTION_INTERVAL:
+                self._apply_retention()
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write_file(self, filename: str, content: str):
+        try:
+            os.makedirs(self.debug_dir, exist_ok=True)
+            file_path = os.path.join(self.debug_dir, filename)
+            if filename.endswith('.gz'):
+                with gzip.open(file_path, 'wt', encoding='utf-8', errors='replace') as f:
+                    f.write(content)
+            else:
+                with open(file_path, 'w', encoding='utf-8', errors='replace') as f:
+                    f.write(content)
+        except Exception as e:
+            print(f"Error saving debug file: {str(e)}", file=sys.stderr)
+
+    def _apply_retention(self):
+        self._last_retention = time.time()
+        try:
+            entries = []
+            with os.scandir(self.debug_dir) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.startswith('gemini_'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        entries.sort()
+        cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+        total = sum(size for _, size, _ in entries)
+        max_total = self.max_total_mb * 1024 * 1024
+        for mtime, size, path in entries:
+            if mtime >= cutoff and total <= max_total:
+                break
             try:
-                print(f"Attempting emergency extraction from {debug_file}", file=sys.stderr)
-                with open(debug_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-
-                time_pattern = r'(?:\d+\.\d+|\d+|\d+:\d+\.\d+)'
-                pattern = (
-                    r'\{\s*"start"\s*:\s*(' + time_pattern + r')\s*,\s*"end"\s*:\s*(' + time_pattern + r')\s*,\s*' +
-                    r'"text"\s*:\s*"([^"]*)"\s*,\s*"language"\s*:\s*"([^"]*)"\s*\}' 
-                )
-                matches = re.findall(pattern, content)
-
-                if matches:
-                    data = []
-                    for start, end, text, language in matches:
-                        data.append({
-                            "start": start,
-                            "end": end,
-                            "text": text,
-                            "language": language
-                        })
-
-                    data.sort(key=lambda x: float(x["start"]))
-                    print(f"Emergency extraction successful: {len(data)} entries recovered", file=sys.stderr)
-                    return json.dumps(data, indent=2)
-            except Exception as rescue_error:
-                print(f"Emergency extraction failed: {rescue_error}", file=sys.stderr)
-
-        raise ValueError(f"Invalid JSON in response: {str(e)}")
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+debug_sink = DebugSink()
 
 def save_debug_file(filename: str, content: str):
-    """Save debug content with proper UTF-8 encoding"""
-    try:
-        debug_dir = os.path.join(os.path.dirname(__file__), 'debug')
-        os.makedirs(debug_dir, exist_ok=True)
+    """Save debug content with proper UTF-8 encoding, off the calling thread"""
+    return debug_sink.write(filename, content)
 
-        file_path = os.path.join(debug_dir, filename)
-        with open(file_path, 'w', encoding='utf-8', errors='replace') as f:
-            f.write(content)
-        return file_path
-    except Exception as e:
-        print(f"Error saving debug file: {str(e)}", file=sys.stderr)
+_MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+def _parse_mp3_frame_header(header: bytes):
+    """Decode a 4-byte MPEG audio frame header, or return None if it is not one."""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((header[1] >> 3) & 0x03)
+    layer = {1: 3, 2: 2, 3: 1}.get((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = _MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header[2] >> 1) & 0x01
+    channels = 1 if (header[3] >> 6) == 3 else 2
+
+    if layer == 1:
+        samples_per_frame = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples_per_frame = 1152 if (layer == 2 or version == 1) else 576
+        frame_length = samples_per_frame // 8 * bitrate // sample_rate + padding
+
+    return {
+        "version": version,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "samples_per_frame": samples_per_frame,
+        "frame_length": frame_length,
+    }
+
+def _probe_mp3(f, file_size: int):
+    head = f.read(10)
+    audio_start = 0
+    if head[:3] == b'ID3' and len(head) == 10:
+        tag_size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        audio_start = 10 + tag_size + (10 if head[5] & 0x10 else 0)
+
+    f.seek(audio_start)
+    data = f.read(64 * 1024)
+    for offset in range(len(data) - 4):
+        frame = _parse_mp3_frame_header(data[offset:offset + 4])
+        if not frame:
+            continue
+        # Require the next frame to line up so random 0xFF bytes are not taken for a header
+        next_offset = offset + frame["frame_length"]
+        if next_offset + 4 <= len(data) and not _parse_mp3_frame_header(data[next_offset:next_offset + 4]):
+            continue
+        break
+    else:
+        return None
+
+    side_info = (32 if frame["channels"] == 2 else 17) if frame["version"] == 1 else (17 if frame["channels"] == 2 else 9)
+    frames = None
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+        if flags & 0x01:
+            frames = int.from_bytes(data[xing + 8:xing + 12], 'big')
+    elif data[offset + 36:offset + 40] == b'VBRI':
+        frames = int.from_bytes(data[offset + 50:offset + 54], 'big')
+
+    if frames:
+        duration = frames * frame["samples_per_frame"] / frame["sample_rate"]
+    else:
+        # Constant bitrate: estimate from the size of the audio data, like ffprobe does
+        audio_bytes = file_size - audio_start - offset
+        f.seek(max(0, file_size - 128))
+        if f.read(3) == b'TAG':
+            audio_bytes -= 128
+        duration = audio_bytes * 8 / frame["bitrate"]
+
+    return {"duration": duration, "sample_rate": frame["sample_rate"], "channels": frame["channels"], "format": "mp3"}
+
+def _probe_wav(f, file_size: int):
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    channels = sample_rate = byte_rate = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:8], 'little')
+        if chunk_id == b'fmt ':
+            fmt = f.read(chunk_size)
+            channels = int.from_bytes(fmt[2:4], 'little')
+            sample_rate = int.from_bytes(fmt[4:8], 'little')
+            byte_rate = int.from_bytes(fmt[8:12], 'little')
+            if chunk_size % 2:
+                f.seek(1, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if not byte_rate:
+                return None
+            # Streamed WAVs can carry a placeholder size; never trust more than the file holds
+            data_size = min(chunk_size, file_size - f.tell())
+            return {"duration": data_size / byte_rate, "sample_rate": sample_rate, "channels": channels, "format": "wav"}
+        else:
+            f.seek(chunk_size + (chunk_size % 2), os.SEEK_CUR)
+
+def _probe_flac(f, file_size: int):
+    if f.read(4) != b'fLaC':
+        return None
+    block_header = f.read(4)
+    if len(block_header) < 4 or (block_header[0] & 0x7F) != 0:
+        return None
+    info = f.read(34)
+    if len(info) < 34:
         return None
+    packed = int.from_bytes(info[10:18], 'big')
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x07) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate or not total_samples:
+        return None
+    return {"duration": total_samples / sample_rate, "sample_rate": sample_rate, "channels": channels, "format": "flac"}
+
+def _probe_ogg(f, file_size: int):
+    page = f.read(4096)
+    if page[:4] != b'OggS':
+        return None
+    packet = page[27 + page[26]:]
+    if packet[:8] == b'OpusHead':
+        channels = packet[9]
+        pre_skip = int.from_bytes(packet[10:12], 'little')
+        sample_rate = int.from_bytes(packet[12:16], 'little') or 48000
+        granule_rate, audio_format = 48000, "opus"
+    elif packet[:7] == b'\x01vorbis':
+        channels = packet[11]
+        sample_rate = int.from_bytes(packet[12:16], 'little')
+        pre_skip, granule_rate, audio_format = 0, sample_rate, "vorbis"
+    else:
+        return None
+
+    # The granule position of the last page is the total number of samples
+    tail_size = min(file_size, 64 * 1024)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+    last_page = tail.rfind(b'OggS')
+    if last_page < 0 or last_page + 14 > len(tail):
+        return None
+    granule = int.from_bytes(tail[last_page + 6:last_page + 14], 'little', signed=True)
+    if granule <= 0 or not granule_rate:
+        return None
+    return {"duration": (granule - pre_skip) / granule_rate, "sample_rate": sample_rate, "channels": channels, "format": audio_format}
+
+_HEADER_PROBES = {
+    '.mp3': _probe_mp3,
+    '.wav': _probe_wav,
+    '.wave': _probe_wav,
+    '.flac': _probe_flac,
+    '.ogg': _probe_ogg,
+    '.oga': _probe_ogg,
+    '.opus': _probe_ogg,
+}
+
+def _detect_header_probe(magic: bytes):
+    if magic.startswith(b'RIFF'):
+        return _probe_wav
+    if magic.startswith(b'fLaC'):
+        return _probe_flac
+    if magic.startswith(b'OggS'):
+        return _probe_ogg
+    if magic.startswith(b'ID3') or _parse_mp3_frame_header(magic):
+        return _probe_mp3
+    return None
+
+def _probe_with_ffprobe(audio_path: str) -> Dict:
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0",
+         "-show_entries", "format=duration,format_name:stream=sample_rate,channels",
+         "-of", "json", audio_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed for {audio_path}: {result.stderr.decode('utf-8', 'replace').strip()}")
+    probe = json.loads(result.stdout)
+    stream = (probe.get("streams") or [{}])[0]
+    return {
+        "duration": float(probe["format"]["duration"]),
+        "sample_rate": int(stream["sample_rate"]) if stream.get("sample_rate") else None,
+        "channels": stream.get("channels"),
+        "format": probe["format"].get("format_name"),
+    }
+
+@lru_cache(maxsize=256)
+def _probe_audio_cached(audio_path: str, size: int, mtime_ns: int) -> Dict:
+    extension = os.path.splitext(audio_path)[1].lower()
+    with open(audio_path, 'rb') as f:
+        # Try the parser for the extension first, then the one the magic bytes point to in case the file is misnamed
+        probes = [_HEADER_PROBES.get(extension), _detect_header_probe(f.read(4))]
+        for probe in dict.fromkeys(probe for probe in probes if probe):
+            f.seek(0)
+            try:
+                info = probe(f, size)
+            except (IndexError, ValueError, ZeroDivisionError):
+                info = None
+            if info and info["duration"] > 0:
+                info["duration"] = round(info["duration"], 6)
+                info["source"] = "header"
+                return info
+
+    info = _probe_with_ffprobe(audio_path)
+    info["source"] = "ffprobe"
+    return info
+
+def probe_audio(audio_path: str) -> Dict:
+    """Return duration, sample rate, channel count and format of an audio file.
+
+    WAV, FLAC, MP3 and Ogg (Vorbis/Opus) headers are parsed in-process; other
+    containers fall back to ffprobe. Results are memoized by path, size and mtime.
+    """
+    audio_path = os.path.abspath(audio_path)
+    stat = os.stat(audio_path)
+    return dict(_probe_audio_cached(audio_path, stat.st_size, stat.st_mtime_ns))
 
 def get_audio_duration(audio_path: str) -> float:
     """Get the duration of the audio file in seconds."""
+    with metrics.span('audio_probe'):
+        return probe_audio(audio_path)["duration"]
+
+@lru_cache(maxsize=256)
+def _hash_file_cached(path: str, size: int, mtime_ns: int, chunk_size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the SHA-256 of a file, streamed in chunks and memoized by path, size and mtime."""
+    stat = os.stat(path)
+    return _hash_file_cached(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, chunk_size)
+
+AUDIO_PREPROCESSING_DEFAULTS = {
+    "enabled": True,
+    "format": "mp3",
+    "sampleRate": 16000,
+    "bitrate": "32k",
+    "trimSilence": True,
+    "silenceThreshold": "-45dB",
+}
+
+_ENCODERS = {
+    "mp3": {"codec": "libmp3lame", "extension": ".mp3"},
+    "opus": {"codec": "libopus", "extension": ".ogg"},
+}
+
+ENCODED_DIR = os.path.join(os.path.dirname(__file__), 'cache', 'encoded')
+# Total size of encoded audio kept; the least recently used files go first
+ENCODED_MAX_BYTES = 512 * 1024 * 1024
+_ENCODED_EXTENSIONS = tuple(encoder["extension"] for encoder in _ENCODERS.values())
+_encoded_lock = threading.Lock()
+
+def _evict_encoded(keep: str) -> None:
+    """Remove the least recently used encoded files and their sidecars until the directory fits the bound."""
+    with _encoded_lock:
+        entries = []
+        with os.scandir(ENCODED_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(_ENCODED_EXTENSIONS) and '.tmp' not in entry.name:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= ENCODED_MAX_BYTES:
+                break
+            if path == keep:
+                continue
+            for stale in (path, os.path.splitext(path)[0] + '.json'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+            total -= size
+
+def detect_edge_silence(audio_path: str, threshold: str = "-45dB", min_silence: float = 0.5):
+    """Return (leading silence end, trailing silence start or None) using ffmpeg's silencedetect."""
     result = subprocess.run(
-        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", audio_path],
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", audio_path,
+         "-af", f"silencedetect=noise={threshold}:d={min_silence}", "-f", "null", "-"],
         stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT
+        stderr=subprocess.PIPE
     )
-    return float(result.stdout)
\ No newline at end of file
+    log = result.stderr.decode('utf-8', 'replace')
+    starts = [float(value) for value in re.findall(r'silence_start: (-?[\d.]+)', log)]
+    ends = [float(value) for value in re.findall(r'silence_end: ([\d.]+)', log)]
+
+    leading_end = ends[0] if starts and ends and starts[0] <= 0.05 else 0.0
+    # A trailing silence has a start but no end, or ends at the very end of the file
+    trailing_start = None
+    if starts and len(starts) > len(ends):
+        trailing_start = starts[-1]
+    elif starts and ends and ends[-1] >= get_audio_duration(audio_path) - 0.05 and starts[-1] > leading_end:
+        trailing_start = starts[-1]
+    return leading_end, trailing_start
+
+def preprocess_audio(audio_path: str, settings: Dict = None) -> Dict:
+    """Transcode audio to a compact mono format before upload, optionally trimming edge silence.
+
+    Returns the path to upload, the ``offset`` in seconds to add to timestamps
+    measured on it, and byte counts. Encoded files are cached by the source's
+    content hash and the settings, up to ENCODED_MAX_BYTES in total. When preprocessing is disabled or fails,
+    the original file is returned unchanged.
+    """
+    settings = {**AUDIO_PREPROCESSING_DEFAULTS, **(settings or {})}
+    original_bytes = os.path.getsize(audio_path)
+    unchanged = {"path": audio_path, "offset": 0.0, "original_bytes": original_bytes,
+                 "encoded_bytes": original_bytes, "encode_seconds": 0.0, "cached": False}
+    encoder = _ENCODERS.get(settings["format"])
+    if not settings["enabled"] or not encoder or not shutil.which('ffmpeg'):
+        return unchanged
+
+    settings_key = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    base_path = os.path.join(ENCODED_DIR, f"{hash_file(audio_path)}_{settings_key}")
+    encoded_path = base_path + encoder["extension"]
+    sidecar_path = base_path + '.json'
+
+    # An unreadable sidecar counts as a miss and the file is encoded again
+    sidecar = read_json(sidecar_path, None) if os.path.exists(encoded_path) else None
+    if isinstance(sidecar, dict) and isinstance(sidecar.get("offset"), (int, float)):
+        offset = sidecar["offset"]
+        try:
+            # The mtime is the entry's last use for eviction
+            os.utime(encoded_path)
+        except OSError:
+            pass
+        return {**unchanged, "path": encoded_path, "offset": offset,
+                "encoded_bytes": os.path.getsize(encoded_path), "cached": True}
+
+    started = time.perf_counter()
+    tmp_path = None
+    try:
+        trim_args = []
+        offset = 0.0
+        if settings["trimSilence"]:
+            leading_end, trailing_start = detect_edge_silence(audio_path, settings["silenceThreshold"])
+            # Keep a little of the silence so the first onset is not cut
+            offset = max(0.0, leading_end - 0.2)
+            if offset > 0:
+                trim_args += ["-ss", f"{offset:.3f}"]
+            if trailing_start is not None and trailing_start > offset:
+                trim_args += ["-to", f"{trailing_start + 0.2:.3f}"]
+
+        os.makedirs(ENCODED_DIR, exist_ok=True)
+        tmp_path = f"{base_path}.{os.getpid()}.{threading.get_ident()}.tmp{encoder['extension']}"
+        with metrics.span('encode'):
+            result = subprocess.run(
+                ["ffmpeg", "-v", "error", "-y", "-i", audio_path, *trim_args, "-vn", "-ac", "1",
+                 "-ar", str(settings["sampleRate"]), "-c:a", encoder["codec"], "-b:a", str(settings["bitrate"]), tmp_path],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode('utf-8', 'replace').strip())
+        # The sidecar goes first so a reader that finds the encoded file also finds its offset
+        write_json_atomic(sidecar_path, {"source": audio_path, "offset": offset, "settings": settings})
+        os.replace(tmp_path, encoded_path)
+        _evict_encoded(keep=encoded_path)
+    except Exception as e:
+        print(f"Audio preprocessing failed, uploading original file: {str(e)}", file=sys.stderr)
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return unchanged
+
+    return {**unchanged, "path": encoded_path, "offset": offset,
+            "encoded_bytes": os.path.getsize(encoded_path), "encode_seconds": time.perf_counter() - started}
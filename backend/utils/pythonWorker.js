@@ -0,0 +1,104 @@
+import path from 'path';
+import readline from 'readline';
+import { spawn } from 'child_process';
+import config from '../config/config.js';
+
+// Get Python executable path from environment variable or use default
+// Always prefer the Python executable from the virtual environment
+export const PYTHON_EXECUTABLE = process.env.PYTHON_EXECUTABLE || path.join(config.rootDir, '.venv', 'Scripts', 'python.exe');
+
+let worker = null;
+let nextRequestId = 1;
+const pendingRequests = new Map();
+
+/**
+ * Start the long-lived Python worker (main.py --mode serve) if it is not running.
+ * @returns {import('child_process').ChildProcess} The worker process.
+ */
+const ensureWorker = () => {
+  if (worker) {
+    return worker;
+  }
+
+  const pythonProcess = spawn(PYTHON_EXECUTABLE, [config.pythonScriptPath, '--mode', 'serve']);
+  const lines = readline.createInterface({ input: pythonProcess.stdout });
+
+  lines.on('line', (line) => {
+    let message;
+    try {
+      message = JSON.parse(line);
+    } catch (error) {
+      console.error('Invalid line from Python worker:', error.message);
+      return;
+    }
+
+    if (message.id === null || message.id === undefined) {
+      if (message.status === 'ready') {
+        console.log(`Python worker ready (pid ${message.pid})`);
+      } else if (message.error) {
+        console.error('Python worker error:', message.error);
+      }
+      return;
+    }
+
+    const pending = pendingRequests.get(message.id);
+    if (!pending) {
+      return;
+    }
+
+    const { id, ...result } = message;
+    if (result.type === 'line') {
+      // Streamed partial result; the request stays pending until its final record
+      if (pending.onLine) {
+        pending.onLine(result);
+      }
+      return;
+    }
+    pendingRequests.delete(message.id);
+
+    if (result.status === 'error') {
+      pending.reject(new Error(result.error || 'Python worker request failed'));
+    } else {
+      pending.resolve(result);
+    }
+  });
+
+  pythonProcess.stderr.on('data', () => {
+    // Don't log the full stderr as it may contain large amounts of data
+    console.error('Python stderr received');
+  });
+
+  const handleExit = (reason) => {
+    if (worker !== pythonProcess) {
+      return;
+    }
+    worker = null;
+    for (const pending of pendingRequests.values()) {
+      pending.reject(new Error(`Python worker stopped: ${reason}`));
+    }
+    pendingRequests.clear();
+  };
+
+  pythonProcess.on('error', (error) => handleExit(error.message));
+  pythonProcess.stdin.on('error', (error) => handleExit(error.message));
+  pythonProcess.on('close', (code) => handleExit(`exit code ${code}`));
+
+  worker = pythonProcess;
+  return worker;
+};
+
+/**
+ * Run a task on the shared Python worker.
+ * @param {string} mode The main.py mode (match, generate_prompt, generate_image).
+ * @param {Object} params The parameters for that mode, named like the CLI flags.
+ * @param {Function} [onLine] Called with each streamed line record (match with stream: true).
+ * @returns {Promise<Object>} The result record returned by the worker.
+ */
+export const runPythonTask = (mode, params, onLine) => {
+  return new Promise((resolve, reject) => {
+    const pythonProcess = ensureWorker();
+    const id = nextRequestId++;
+    pendingRequests.set(id, { resolve, reject, onLine });
+    pythonProcess.stdin.write(JSON.stringify({ id, mode, ...params }) + '\n');
+  });
+};
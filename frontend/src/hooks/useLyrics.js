@@ -136,6 +136,7 @@ const useLyrics = () => {
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
       let buffer = '';
+      const streamedLines = [];
 
       while (true) {
         const { done, value } = await reader.read();
@@ -153,7 +154,11 @@ const useLyrics = () => {
             try {
               const data = JSON.parse(line);
 
-              if (data.type === 'progress') {
+              if (data.type === 'line') {
+                // Show each line as soon as it is aligned; the final result replaces them
+                streamedLines.push(data.line);
+                setMatchedLyrics([...streamedLines]);
+              } else if (data.type === 'progress') {
                 setMatchingProgress(data.progress);
                 setProcessingStatus(data.status);
               } else if (data.type === 'result') {
@@ -170,7 +175,7 @@ const useLyrics = () => {
                   setError('Received invalid lyrics data from server');
                 }
               } else if (data.type === 'error') {
-                throw new Error(data.message || data.error);
+                setError(`Matching failed: ${data.message || data.error}`);
               }
             } catch (parseError) {
               console.error('Error parsing server message:', parseError);